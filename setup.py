@@ -46,6 +46,9 @@ setup(
         'requests>=2.3.0',
         'schedule>=0.3.1',
     ],
+    extras_require={
+        'analysis': ['numpy'],
+    },
 
     # Metadata
     author='James Newell',
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 44.1 kHz, 16 bit stereo
+SAMPLE_RATE = 44100
+FRAME_SIZE = 4
+
+
+class DropoutDetector(object):
+    """Looks for network dropouts in the PCM of a track while it is
+    captured: runs of digital silence in the middle of the track that
+    start right after audible audio, and tracks that end short of their
+    duration. Silence detection needs NumPy, the length check does not.
+    """
+
+    # a zero run at least this long (seconds) is a gap ...
+    min_gap = 0.2
+    # ... if the audio right before it was at least this loud
+    abrupt_level = 1024
+    # any zero run in the middle of the track this long is a gap
+    max_silence = 3.0
+    # missing audio at the end we tolerate (seconds)
+    max_missing = 1.0
+
+    def __init__(self):
+        self.enabled = np is not None
+        self.start(0)
+
+    def start(self, duration):
+        self.duration = duration / 1000.0
+        self.frames = 0
+        self.gaps = []
+
+        # zero run that is still open at the end of the last chunk
+        self._run_start = None
+        self._run_abrupt = False
+        self._last_level = 0
+
+    def feed(self, data):
+        num_frames = len(data) // FRAME_SIZE
+        if num_frames == 0:
+            return
+        offset = self.frames
+        self.frames += num_frames
+        if not self.enabled:
+            return
+
+        samples = np.frombuffer(data, dtype='<i2',
+                                count=num_frames * 2).reshape(-1, 2)
+        level = np.abs(samples.astype(np.int32)).max(axis=1)
+        silent = level == 0
+
+        # starts and ends of the zero runs in this chunk
+        edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+
+        for start, end in zip(starts, ends):
+            if start == 0 and self._run_start is not None:
+                # continues the run of the previous chunk
+                run_start = self._run_start
+                abrupt = self._run_abrupt
+            else:
+                run_start = offset + start
+                prev_level = level[start - 1] if start > 0 \
+                    else self._last_level
+                abrupt = prev_level >= self.abrupt_level
+
+            if end == num_frames:
+                # still open, decided by the next chunk or finish()
+                self._run_start = run_start
+                self._run_abrupt = abrupt
+            else:
+                self._run_start = None
+                self.close_run(run_start, offset + end, abrupt)
+
+        if not silent[-1]:
+            self._run_start = None
+        self._last_level = level[-1]
+
+    def close_run(self, start, end, abrupt):
+        # silence at the very start is part of the track
+        if start == 0:
+            return
+        length = (end - start) / float(SAMPLE_RATE)
+        if (abrupt and length >= self.min_gap) or length >= self.max_silence:
+            self.gaps.append((start / float(SAMPLE_RATE), length))
+
+    def finish(self):
+        """returns a list of the problems found in the track"""
+        problems = []
+
+        # a zero run that lasts until the end is a truncated track if it
+        # started abruptly, otherwise it is just a quiet ending
+        if self._run_start is not None and self._run_abrupt:
+            length = (self.frames - self._run_start) / float(SAMPLE_RATE)
+            if length >= self.max_missing:
+                problems.append("%.1fs of silence at the end" % length)
+        self._run_start = None
+
+        for start, length in self.gaps:
+            problems.append("%.1fs gap at %d:%02d" %
+                            (length, int(start) // 60, int(start) % 60))
+
+        captured = self.frames / float(SAMPLE_RATE)
+        if self.duration > 0 and \
+                captured < self.duration - self.max_missing:
+            problems.append("only %.1fs of %.1fs captured" %
+                            (captured, self.duration))
+        return problems
+
+
+# ReplayGain 2.0 reference level (LUFS)
+REFERENCE_LOUDNESS = -18.0
+
+# reference level of the R128 gain tags of Opus files (LUFS)
+R128_REFERENCE_LOUDNESS = -23.0
+
+# BS.1770 gating thresholds
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+
+def energy_to_lufs(energy):
+    return -0.691 + 10 * np.log10(energy)
+
+
+def lufs_to_energy(lufs):
+    return 10 ** ((lufs + 0.691) / 10)
+
+
+def k_weighting(block_size, rate=SAMPLE_RATE):
+    """power response of the BS.1770 K-weighting filter (high shelf and
+    high pass, coefficients as in libebur128) at the rfft bins of a block
+    of block_size samples, with the factor 2 of the bins that stand for
+    a positive and a negative frequency folded in"""
+    def response(b, a, z):
+        return (b[0] + b[1] / z + b[2] / z ** 2) / \
+            (a[0] + a[1] / z + a[2] / z ** 2)
+
+    f0 = 1681.974450955533
+    gain = 3.999843853973347
+    q = 0.7071752369554196
+    k = np.tan(np.pi * f0 / rate)
+    vh = 10 ** (gain / 20.0)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf_b = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0,
+               (vh - vb * k / q + k * k) / a0]
+    shelf_a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = np.tan(np.pi * f0 / rate)
+    a0 = 1 + k / q + k * k
+    pass_b = [1.0, -2.0, 1.0]
+    pass_a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+    freqs = np.fft.rfftfreq(block_size, 1.0 / rate)
+    z = np.exp(2j * np.pi * freqs / rate)
+    weights = np.abs(response(shelf_b, shelf_a, z) *
+                     response(pass_b, pass_a, z)) ** 2
+    weights[1:] *= 2
+    if block_size % 2 == 0:
+        weights[-1] /= 2
+    return weights
+
+
+class Loudness(object):
+    """Gating block energies and sample peak of a track (or of all the
+    tracks of an album)"""
+
+    def __init__(self, blocks, peak):
+        self.blocks = blocks
+        self.peak = peak
+
+    @classmethod
+    def combine(cls, loudnesses):
+        return cls(np.concatenate([l.blocks for l in loudnesses]),
+                   max(l.peak for l in loudnesses))
+
+    @property
+    def integrated(self):
+        """integrated loudness in LUFS, None for silence"""
+        blocks = self.blocks[self.blocks > lufs_to_energy(ABSOLUTE_GATE)]
+        if len(blocks) == 0:
+            return None
+        threshold = energy_to_lufs(blocks.mean()) + RELATIVE_GATE
+        blocks = blocks[blocks > lufs_to_energy(threshold)]
+        return float(energy_to_lufs(blocks.mean()))
+
+    @property
+    def gain(self):
+        """ReplayGain 2.0 gain in dB"""
+        integrated = self.integrated
+        if integrated is None:
+            return None
+        return REFERENCE_LOUDNESS - integrated
+
+
+class LoudnessMeter(object):
+    """Measures the EBU R128 (ITU-R BS.1770) loudness and sample peak of
+    a track from the PCM as it is captured. Every 100 ms segment is
+    K-weighted in the frequency domain, so a chunk is a single FFT call
+    instead of a filter running over each sample; 400 ms gating blocks
+    overlap by three segments. Needs NumPy.
+    """
+
+    segment_size = SAMPLE_RATE // 10
+    segments_per_block = 4
+
+    def __init__(self):
+        self.enabled = np is not None
+        if self.enabled:
+            self.weights = k_weighting(self.segment_size)
+        self.start()
+
+    def start(self):
+        self.segments = []
+        self.peak = 0
+        self._pending = None
+
+    def feed(self, data):
+        if not self.enabled:
+            return
+        num_frames = len(data) // FRAME_SIZE
+        if num_frames == 0:
+            return
+
+        samples = np.frombuffer(data, dtype='<i2',
+                                count=num_frames * 2).reshape(-1, 2)
+        self.peak = max(self.peak,
+                        int(np.abs(samples.astype(np.int32)).max()))
+        if self._pending is not None:
+            samples = np.concatenate((self._pending, samples))
+
+        count = len(samples) // self.segment_size
+        # data is reused once we return, keep a copy of what is left
+        self._pending = samples[count * self.segment_size:].copy()
+        if count == 0:
+            return
+
+        segments = samples[:count * self.segment_size].reshape(
+            count, self.segment_size, 2) / 32768.0
+        spectra = np.fft.rfft(segments, axis=1)
+        power = spectra.real ** 2 + spectra.imag ** 2
+        # mean square of the weighted signal, both channels weigh 1.0
+        energy = np.einsum('ijk,j->i', power, self.weights) / \
+            (self.segment_size ** 2)
+        self.segments.append(energy)
+
+    def finish(self):
+        """returns the Loudness of the track, None if it could not be
+        measured"""
+        if not self.enabled or len(self.segments) == 0:
+            return None
+        segments = np.concatenate(self.segments)
+        self.segments = []
+        self._pending = None
+        if len(segments) < self.segments_per_block:
+            return None
+
+        size = self.segments_per_block
+        blocks = np.convolve(segments, np.ones(size) / size, mode='valid')
+        return Loudness(blocks, self.peak / 32768.0)
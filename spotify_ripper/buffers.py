@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import threading
+from collections import deque
+
+
+class PCMBuffer(object):
+    """A preallocated buffer holding one delivery of PCM data"""
+
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.length = 0
+        self.sample_rate = 0
+        self.num_frames = 0
+
+    def data(self):
+        return memoryview(self.buffer)[:self.length]
+
+
+class PCMBufferPool(object):
+    """Fixed-capacity ring of recycled PCM buffers between libspotify's
+    music delivery callback and the ripper thread.
+
+    When every buffer is in use, put() consumes nothing so that libspotify
+    delivers the same data again later instead of us buffering without
+    limit while the encoder is stalled.
+    """
+
+    capacity = 256
+    buffer_size = 32768
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._free = [PCMBuffer(self.buffer_size)
+                      for i in range(self.capacity)]
+        self._filled = deque()
+
+        # stats
+        self.high_water = 0
+        self.full_count = 0
+
+    @property
+    def depth(self):
+        """number of buffers waiting to be ripped"""
+        with self._cond:
+            return len(self._filled)
+
+    def put(self, sample_rate, frame_bytes, num_frames):
+        """copies as many frames as fit in a free buffer, returns the
+        number of frames consumed (0 if the pool is full)"""
+        if num_frames == 0:
+            return 0
+        frame_size = len(frame_bytes) // num_frames
+
+        with self._cond:
+            if len(self._free) == 0:
+                self.full_count += 1
+                return 0
+            buf = self._free.pop()
+
+        frames = min(num_frames, self.buffer_size // frame_size)
+        length = frames * frame_size
+        memoryview(buf.buffer)[:length] = memoryview(frame_bytes)[:length]
+        buf.length = length
+        buf.sample_rate = sample_rate
+        buf.num_frames = frames
+
+        with self._cond:
+            self._filled.append(buf)
+            if len(self._filled) > self.high_water:
+                self.high_water = len(self._filled)
+            self._cond.notify()
+        return frames
+
+    def get(self, timeout=None):
+        """returns the next filled buffer or None after timeout, the
+        buffer has to be given back with release()"""
+        with self._cond:
+            if len(self._filled) == 0:
+                self._cond.wait(timeout)
+                if len(self._filled) == 0:
+                    return None
+            return self._filled.popleft()
+
+    def release(self, buf):
+        with self._cond:
+            buf.length = 0
+            self._free.append(buf)
+
+    def clear(self):
+        """drop anything left over from the previous track"""
+        with self._cond:
+            self._free.extend(self._filled)
+            self._filled.clear()
+
+    def reset_stats(self):
+        with self._cond:
+            self.high_water = len(self._filled)
+            self.full_count = 0
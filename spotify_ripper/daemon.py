@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.manifest import Manifest
+import os
+import hmac
+import json
+import binascii
+import itertools
+import threading
+
+try:
+    # Python 3
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Python 2
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# json strings are unicode on Python 2 too
+text_type = type("")
+
+
+class Job(object):
+    """URIs and per-job options submitted to the daemon"""
+
+    # options a job can override
+    options = ["format", "directory", "overwrite", "comment", "grouping",
+               "playlist_m3u", "playlist_wpl", "rip_order"]
+    array_options = ["format", "directory", "comment", "grouping"]
+    bool_options = ["overwrite", "playlist_m3u", "playlist_wpl"]
+    # null sets these back to their default
+    nullable_options = ["directory", "comment", "grouping"]
+    rip_orders = ["original", "album", "shortest"]
+
+    ids = itertools.count(1)
+
+    def __init__(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("job must be a JSON object")
+        uris = request.get("uri", [])
+        self.uris = [uris] if not isinstance(uris, list) else uris
+        if not all(isinstance(uri, text_type) for uri in self.uris):
+            raise ValueError("uri must be a string or a list of strings")
+        self.arg_options = {}
+        for option in self.options_in(request):
+            value = self.check_option(option, request[option])
+            if option in self.array_options and value is not None:
+                value = [value]
+            self.arg_options[option] = value
+        self.id = next(self.ids)
+        self.events = queue.Queue()
+
+    @classmethod
+    def check_option(cls, option, value):
+        """raises ValueError if value has the wrong type for option, so a
+        bad job is refused instead of failing halfway through"""
+        if value is None and option in cls.nullable_options:
+            return value
+        if option in cls.bool_options:
+            if not isinstance(value, bool):
+                raise ValueError(option + " must be true or false")
+        elif option == "rip_order":
+            if value not in cls.rip_orders:
+                raise ValueError("rip_order must be one of " +
+                                 ", ".join(cls.rip_orders))
+        elif not isinstance(value, text_type):
+            raise ValueError(option + " must be a string")
+        return value
+
+    @classmethod
+    def options_in(cls, request):
+        return [option for option in cls.options if option in request]
+
+    def emit(self, status, **kwargs):
+        kwargs["job"] = self.id
+        kwargs["status"] = status
+        self.events.put(kwargs)
+
+
+class JobTracks(object):
+    """Counts and reports the tracks of a job. A captured track is only
+    reported once the finisher encoded and tagged it, which may be while
+    the next track is captured"""
+
+    def __init__(self, job):
+        self.job = job
+        self.counts = {"ripped": 0, "skipped": 0, "failed": 0}
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def expect(self, uri, audio_file):
+        with self._lock:
+            self.files.setdefault(uri, []).append(audio_file)
+
+    def report(self, uri, status):
+        with self._lock:
+            files = self.files.get(uri)
+            if not files:
+                return
+            audio_file = files.pop(0)
+            if len(files) == 0:
+                del self.files[uri]
+            self.counts[status] += 1
+        self.job.emit(status, uri=uri, file=audio_file)
+
+    def logged(self, track, success):
+        """called for every success or failure logged by the ripper"""
+        self.report(track.link.uri, "ripped" if success else "failed")
+
+    def fail_pending(self):
+        """tracks that never finished, e.g. because the job aborted"""
+        for uri in list(self.files.keys()):
+            while uri in self.files:
+                self.report(uri, "failed")
+
+
+def daemon_token():
+    """the token every request to the daemon needs, created on first use
+    in the settings directory and only readable by the user"""
+    path = os.path.join(settings_dir(), "daemon_token")
+    try:
+        fd = os.open(enc_str(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                     0o600)
+    except OSError:
+        # already there, make sure nobody else can read it
+        os.chmod(enc_str(path), 0o600)
+        with open(enc_str(path), "r") as f:
+            token = f.read().strip()
+        if len(token) > 0:
+            return token
+        fd = os.open(enc_str(path), os.O_WRONLY | os.O_TRUNC)
+    token = binascii.hexlify(os.urandom(24)).decode("ascii")
+    with os.fdopen(fd, "w") as f:
+        f.write(token + "\n")
+    return token
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code, obj):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write((json.dumps(obj) + "\n").encode("utf-8"))
+
+    def authorized(self):
+        """any local user can connect, only the ones that can read the
+        token file may submit jobs"""
+        expected = "Bearer " + self.server.job_server.token
+        given = self.headers.get("Authorization", "")
+        if hmac.compare_digest(given.encode("utf-8"),
+                               expected.encode("utf-8")):
+            return True
+        self.send_json(401, {"error": "missing or wrong token"})
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+        self.send_json(200, self.server.job_server.status())
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            job = Job(request)
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        if len(job.uris) == 0:
+            self.send_json(400, {"error": "no uri given"})
+            return
+
+        self.server.job_server.submit(job)
+
+        # stream the status of the job as JSON lines
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        while True:
+            event = job.events.get()
+            try:
+                self.wfile.write((json.dumps(event) + "\n").encode("utf-8"))
+                self.wfile.flush()
+            except (IOError, OSError):
+                # client went away, the job keeps running
+                break
+            if event["status"] == "done":
+                break
+
+
+class JobServer(object):
+    """Keeps the ripper logged in and rips jobs submitted over a local
+    HTTP API, one job after another.
+
+    ``POST /jobs`` with a JSON body such as
+    ``{"uri": ["spotify:album:..."], "format": "{artist}/{track}.{ext}"}``
+    queues a job and streams its status back as JSON lines.
+    ``GET /jobs`` lists the running and queued jobs. Every request needs
+    the token of the ``daemon_token`` file in the settings directory as
+    an ``Authorization: Bearer`` header.
+    """
+
+    def __init__(self, args, ripper):
+        self.args = args
+        self.ripper = ripper
+        self.port = args.daemon
+        self.jobs = queue.Queue()
+        self.queued = []
+        self.current_job = None
+        self._lock = threading.Lock()
+        self.server = None
+        self.token = None
+
+    def status(self):
+        with self._lock:
+            return {
+                "running": self.current_job.id
+                if self.current_job is not None else None,
+                "queued": [job.id for job in self.queued]
+            }
+
+    def submit(self, job):
+        with self._lock:
+            self.queued.append(job)
+        self.jobs.put(job)
+        job.emit("queued", position=self.jobs.qsize())
+
+    def start(self):
+        self.token = daemon_token()
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port),
+                                          JobRequestHandler)
+        self.server.job_server = self
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name="SpotifyJobServer")
+        thread.daemon = True
+        thread.start()
+        print(Fore.GREEN + "Waiting for jobs on http://127.0.0.1:" +
+              str(self.port) + "/jobs" + Fore.RESET)
+        print(Fore.YELLOW + "Requests need the token in " +
+              os.path.join(settings_dir(), "daemon_token") + Fore.RESET)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def run_jobs(self):
+        ripper = self.ripper
+
+        self.start()
+        while not ripper.abort.is_set():
+            try:
+                job = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            with self._lock:
+                self.queued.remove(job)
+                self.current_job = job
+            try:
+                self.run_job(job)
+            finally:
+                with self._lock:
+                    self.current_job = None
+        self.stop()
+
+    def run_job(self, job):
+        ripper = self.ripper
+
+        print(Fore.GREEN + "Starting job " + str(job.id) + Fore.RESET)
+        previous = apply_arg_options(self.args, job.arg_options)
+        ripper.track_path_cache.clear()
+        tracks = JobTracks(job)
+        ripper.post.listener = tracks.logged
+        try:
+            ripper.manifest = Manifest(self.args, ripper)
+            ripper.manifest.resolve(job.uris)
+            ripper.progress.calc_total(ripper.manifest)
+            job.emit("resolved", tracks=len(ripper.manifest))
+
+            def rip_item(item):
+                uri = item.track.link.uri
+                tracks.expect(uri, item.audio_file)
+                job.emit("ripping", uri=uri, file=item.audio_file)
+
+                # ripped tracks are reported by tracks.logged
+                success = ripper.rip_item(item)
+                if not success:
+                    tracks.report(uri, "failed")
+                elif item.skip:
+                    tracks.report(uri, "skipped")
+                return success
+
+            ripper.rip_manifest(rip_item)
+        except Exception as e:
+            print(Fore.RED + "Job " + str(job.id) + " failed: " + str(e) +
+                  Fore.RESET)
+            job.emit("error", error=str(e))
+        finally:
+            ripper.wait_finished()
+            ripper.post.listener = None
+            ripper.encoders.cancel()
+            apply_arg_options(self.args, previous)
+            ripper.track_path_cache.clear()
+            ripper.progress.reset_total()
+            tracks.fail_pending()
+            job.emit("done", **tracks.counts)
+            print(Fore.GREEN + "Finished job " + str(job.id) + Fore.RESET)
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.governor import governed_command
+import os
+import re
+import sys
+import json
+import math
+import time
+import shutil
+import struct
+import tempfile
+import subprocess
+
+# 44.1 kHz, 16 bit stereo
+SAMPLE_RATE = 44100
+
+
+class Backend(object):
+    """A program that can encode the captured PCM to an output type.
+    `build` returns its command line for the settings in args, `codec` is
+    the encoder an ffmpeg style program must have been built with and
+    `usable` tells if the backend supports the settings in args"""
+
+    def __init__(self, name, output_type, program, package, build,
+                 codec=None, usable=None):
+        self.name = name
+        self.output_type = output_type
+        self.program = program
+        self.package = package
+        self.build = build
+        self.codec = codec
+        self.usable = usable if usable is not None else lambda args: True
+
+    def command(self, args, audio_file_enc):
+        return self.build(self, args, audio_file_enc)
+
+
+def flac_command(backend, args, audio_file_enc):
+    return (["flac", "-f", ("-" + str(args.comp)), "--silent",
+             "--endian", "little", "--channels", "2", "--bps", "16",
+             "--sample-rate", "44100", "--sign", "signed", "-o",
+             audio_file_enc, "-"], False)
+
+
+def alac_command(backend, args, audio_file_enc):
+    return (["avconv", "-nostats", "-loglevel", "0", "-y", "-f", "s16le",
+             "-ar", "44100", "-ac", "2", "-channel_layout", "stereo", "-i",
+             "-", "-acodec", "alac", audio_file_enc], False)
+
+
+def oggenc_command(backend, args, audio_file_enc):
+    if args.cbr:
+        return (["oggenc", "--quiet", "--raw", "-b", args.bitrate, "-o",
+                 audio_file_enc, "-"], False)
+    else:
+        return (["oggenc", "--quiet", "--raw", "-q", args.vbr, "-o",
+                 audio_file_enc, "-"], False)
+
+
+def opusenc_command(backend, args, audio_file_enc):
+    if args.cbr:
+        return (["opusenc", "--quiet", "--comp", args.comp, "--cvbr",
+                 "--bitrate", str(int(args.bitrate) / 2), "--raw",
+                 "--raw-rate", "44100", "-", audio_file_enc], False)
+    else:
+        return (["opusenc", "--quiet", "--comp", args.comp, "--vbr",
+                 "--bitrate", args.vbr, "--raw", "--raw-rate", "44100",
+                 "-", audio_file_enc], False)
+
+
+def faac_command(backend, args, audio_file_enc):
+    if args.cbr:
+        return (["faac", "-P", "-X", "-b", args.bitrate, "-o",
+                 audio_file_enc, "-"], True)
+    else:
+        return (["faac", "-P", "-X", "-q", args.vbr, "-o",
+                 audio_file_enc, "-"], True)
+
+
+def fdkaac_command(backend, args, audio_file_enc):
+    if args.cbr:
+        return (["fdkaac", "-S", "-R", "-b",
+                 args.bitrate, "-o", audio_file_enc, "-"], False)
+    else:
+        return (["fdkaac", "-S", "-R", "-m", args.vbr,
+                 "-o", audio_file_enc, "-"], False)
+
+
+def lame_command(backend, args, audio_file_enc):
+    lame_args = ["lame", "--silent"]
+
+    if args.stereo_mode is not None:
+        lame_args.extend(["-m", args.stereo_mode])
+
+    if args.cbr:
+        lame_args.extend(["-cbr", "-b", args.bitrate])
+    else:
+        lame_args.extend(["-V", args.vbr])
+
+    lame_args.extend(["-h", "-r", "-", audio_file_enc])
+    return (lame_args, False)
+
+
+# muxer and quality options of the ffmpeg/avconv encoders, the same
+# settings the native tools get
+av_formats = {
+    "mp3": "mp3",
+    "flac": "flac",
+    "ogg": "ogg",
+    "opus": "ogg",
+    "aac": "adts",
+    "m4a": "ipod",
+    "alac.m4a": "ipod",
+}
+
+
+def av_quality(args, output_type):
+    if output_type == "flac":
+        return ["-compression_level", str(args.comp)]
+    elif output_type == "mp3":
+        # same as lame -h
+        quality = ["-compression_level", "2"]
+        if args.cbr:
+            return quality + ["-b:a", args.bitrate + "k"]
+        return quality + ["-q:a", args.vbr]
+    elif output_type == "ogg":
+        if args.cbr:
+            return ["-b:a", args.bitrate + "k"]
+        return ["-q:a", args.vbr]
+    elif output_type == "opus":
+        quality = ["-compression_level", str(args.comp)]
+        if args.cbr:
+            return quality + ["-vbr", "constrained", "-b:a",
+                              str(int(args.bitrate) // 2) + "k"]
+        return quality + ["-vbr", "on", "-b:a", args.vbr + "k"]
+    elif output_type == "aac":
+        return ["-b:a", args.bitrate + "k"]
+    elif output_type == "m4a":
+        if args.cbr:
+            return ["-b:a", args.bitrate + "k"]
+        return ["-vbr", args.vbr]
+    return []
+
+
+def av_command(backend, args, audio_file_enc):
+    return ([backend.program, "-nostats", "-loglevel", "0", "-y",
+             "-f", "s16le", "-ar", "44100", "-ac", "2", "-i", "-",
+             "-threads", "0",
+             "-c:a", backend.codec] +
+            av_quality(args, backend.output_type) +
+            ["-f", av_formats[backend.output_type], audio_file_enc], False)
+
+
+def av_backends(program, package):
+    """the formats ffmpeg and avconv encode as well as the native tools"""
+    return [
+        Backend(program, "mp3", program, package, av_command,
+                codec="libmp3lame",
+                # the mp3 encoder only knows joint stereo on or off
+                usable=lambda args: args.stereo_mode is None),
+        Backend(program, "flac", program, package, av_command,
+                codec="flac"),
+        Backend(program, "ogg", program, package, av_command,
+                codec="libvorbis"),
+        Backend(program, "opus", program, package, av_command,
+                codec="libopus"),
+        # vbr quality means something else to its aac encoder
+        Backend(program, "aac", program, package, av_command,
+                codec="aac", usable=lambda args: args.cbr),
+        Backend(program, "m4a", program, package, av_command,
+                codec="libfdk_aac"),
+        Backend(program, "alac.m4a", program, package, av_command,
+                codec="alac"),
+    ]
+
+
+# the native tool of each output type comes first and is used if the
+# benchmark can not decide
+backends = [
+    Backend("lame", "mp3", "lame", "lame", lame_command),
+    Backend("flac", "flac", "flac", "flac", flac_command),
+    Backend("oggenc", "ogg", "oggenc", "vorbis-tools", oggenc_command),
+    Backend("opusenc", "opus", "opusenc", "opus-tools", opusenc_command),
+    Backend("faac", "aac", "faac", "faac", faac_command),
+    Backend("fdkaac", "m4a", "fdkaac", "fdk-aac-encoder", fdkaac_command),
+    Backend("avconv", "alac.m4a", "avconv", "libav-tools", alac_command),
+] + av_backends("ffmpeg", "ffmpeg") + [
+    backend for backend in av_backends("avconv", "libav-tools")
+    if backend.output_type != "alac.m4a"]
+
+
+def backends_for(output_type):
+    return [backend for backend in backends
+            if backend.output_type == output_type]
+
+
+def native_backend(output_type):
+    candidates = backends_for(output_type)
+    return candidates[0] if len(candidates) > 0 else None
+
+
+def find_backend(output_type, name):
+    for backend in backends_for(output_type):
+        if backend.name == name:
+            return backend
+    return None
+
+
+def encoder_command(args, output_type, audio_file_enc):
+    """returns the command line of the encoder that reads raw PCM from
+    stdin and writes audio_file_enc, and whether its output needs to be
+    silenced. Returns (None, False) for output types that are written
+    without an encoder"""
+    command, quiet = codec_command(args, output_type, audio_file_enc)
+    return governed_command(args, command), quiet
+
+
+def codec_command(args, output_type, audio_file_enc):
+    """the encoder command line without the --encoder-* settings, of the
+    fastest backend that supports the settings in args"""
+    backend = pick_backend(args, output_type)
+    if backend is None:
+        return (None, False)
+    return backend.command(args, audio_file_enc)
+
+
+def pick_backend(args, output_type):
+    ranking = getattr(args, "encoder_backends", {}).get(output_type, [])
+    for name in ranking:
+        backend = find_backend(output_type, name)
+        if backend is not None and backend.usable(args):
+            return backend
+    return native_backend(output_type)
+
+
+def list_encoders(program):
+    """the audio encoders an ffmpeg style program was built with"""
+    try:
+        proc = subprocess.Popen([program, "-encoders"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+    except OSError:
+        return []
+    return re.findall(r"^\s*A\S*\s+(\S+)\s",
+                      out.decode("utf-8", "replace"), re.MULTILINE)
+
+
+def test_pcm(seconds):
+    """a 440 Hz tone of the given length"""
+    frames = [int(16384 * math.sin(2 * math.pi * 440 * i / SAMPLE_RATE))
+              for i in range(SAMPLE_RATE)]
+    second = struct.pack(str("<%dh" % (SAMPLE_RATE * 2)),
+                         *[s for s in frames for channel in range(2)])
+    return second * seconds
+
+
+class EncoderBenchmark(object):
+    """Probes which backends of an output type are installed, encodes a
+    few seconds of audio with each of them and ranks them by speed. The
+    probes and timings are cached in the settings dir until a program or
+    the encoder settings change, so this only runs once"""
+
+    seconds = 10
+
+    def __init__(self):
+        self.path = os.path.join(settings_dir(), "encoder_benchmark.json")
+        self.results = {"encoders": {}, "timings": {}}
+        self.changed = False
+        self._pcm = None
+        try:
+            with open(enc_str(self.path), "r") as bench_file:
+                results = json.load(bench_file)
+            if all(isinstance(results.get(key), dict)
+                   for key in self.results.keys()):
+                self.results = results
+        except (IOError, OSError, ValueError):
+            pass
+
+    def fingerprint(self, program):
+        path = which(program)
+        try:
+            stat = os.stat(enc_str(path))
+        except (OSError, TypeError):
+            return None
+        return {"program": path, "mtime": int(stat.st_mtime),
+                "size": stat.st_size}
+
+    def has_encoder(self, program, codec):
+        """True if the ffmpeg style program was built with the codec"""
+        fingerprint = self.fingerprint(program)
+        cached = self.results["encoders"].get(program)
+        if cached is None or cached.get("fingerprint") != fingerprint:
+            cached = {"fingerprint": fingerprint,
+                      "encoders": list_encoders(program)}
+            self.results["encoders"][program] = cached
+            self.changed = True
+        return codec in cached["encoders"]
+
+    def installed(self, output_type):
+        """the backends of output_type whose program is installed"""
+        installed = []
+        for backend in backends_for(output_type):
+            if which(backend.program) is None:
+                continue
+            if backend.codec is not None and \
+                    not self.has_encoder(backend.program, backend.codec):
+                continue
+            installed.append(backend)
+        return installed
+
+    def time(self, args, backend):
+        """seconds the backend takes to encode the test audio with the
+        settings in args, None if it does not work"""
+        # the command line holds every setting that affects the speed
+        command, quiet = backend.command(args, "OUTPUT")
+        key = backend.output_type + "/" + backend.name + ": " + \
+            " ".join(command[1:])
+        fingerprint = self.fingerprint(backend.program)
+        cached = self.results["timings"].get(key)
+        if cached is not None and cached.get("fingerprint") == fingerprint:
+            return cached["time"]
+
+        print(Fore.YELLOW + "Benchmarking the " + backend.name + " " +
+              backend.output_type + " encoder..." + Fore.RESET)
+        elapsed = self.run(args, backend)
+        self.results["timings"][key] = {"fingerprint": fingerprint,
+                                        "time": elapsed}
+        self.changed = True
+        return elapsed
+
+    def run(self, args, backend):
+        if self._pcm is None:
+            self._pcm = test_pcm(self.seconds)
+        tmp_dir = tempfile.mkdtemp(prefix="spotify-ripper-")
+        audio_file_enc = os.path.join(tmp_dir, "bench." + backend.output_type)
+        try:
+            command, quiet = backend.command(args, audio_file_enc)
+            start = time.time()
+            proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            proc.communicate(self._pcm)
+            elapsed = time.time() - start
+            if proc.returncode != 0 or \
+                    not os.path.exists(audio_file_enc) or \
+                    os.path.getsize(audio_file_enc) == 0:
+                return None
+            return elapsed
+        except OSError:
+            return None
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            if not path_exists(os.path.dirname(self.path)):
+                os.makedirs(enc_str(os.path.dirname(self.path)))
+            with open(enc_str(self.path), "w") as bench_file:
+                json.dump(self.results, bench_file, indent=2,
+                          sort_keys=True)
+        except (IOError, OSError) as e:
+            print(Fore.YELLOW + "Warning: could not write encoder "
+                  "benchmark " + self.path + Fore.RESET)
+            print(str(e))
+
+
+def select_backends(args, outputs):
+    """ranks the installed backends of every output type, fastest first.
+    outputs is a list of (output_type, options) with the options the
+    output is encoded with. Returns (rankings, missing) where missing are
+    the output types no installed backend can encode with their options"""
+    benchmark = EncoderBenchmark()
+    rankings = {}
+    missing = []
+    for output_type, options in outputs:
+        if native_backend(output_type) is None:
+            continue
+        _args = output_args(args, options)
+
+        if output_type not in rankings:
+            candidates = benchmark.installed(output_type)
+            if len(candidates) > 1:
+                timed = []
+                for backend in candidates:
+                    if not backend.usable(_args):
+                        # can't run it with these settings, keep it last
+                        timed.append((sys.float_info.max, backend))
+                        continue
+                    elapsed = benchmark.time(_args, backend)
+                    if elapsed is not None:
+                        timed.append((elapsed, backend))
+                timed.sort(key=lambda t: t[0])
+                candidates = [backend for elapsed, backend in timed]
+            rankings[output_type] = [backend.name for backend in candidates]
+
+        if not any(find_backend(output_type, name).usable(_args)
+                   for name in rankings[output_type]):
+            missing.append(output_type)
+
+    benchmark.save()
+    return rankings, missing
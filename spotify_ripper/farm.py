@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore, AnsiToWin32
+from spotify_ripper.utils import *
+from spotify_ripper.ripper import Ripper
+from spotify_ripper.manifest import ManifestItem, ManifestSource
+import os
+import sys
+import copy
+import signal
+import multiprocessing
+import spotify
+
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+
+def worker_args(args, settings_dir):
+    """copy of the command-line options for a worker process"""
+    _args = copy.copy(args)
+    _args.uri = []
+    _args.workers = None
+    _args.settings = [settings_dir]
+
+    # workers login with the credentials remembered in their settings dir
+    _args.user = None
+    _args.password = None
+    _args.last = True
+
+    # workers log to a file in their settings dir
+    _args.log = [os.path.join(settings_dir, "worker.log")]
+    _args.has_log = True
+
+    # the supervisor takes care of everything playlist related
+    _args.fail_log = None
+    _args.playlist_m3u = False
+    _args.playlist_wpl = False
+    _args.playlist_sync = False
+
+    # the supervisor records a track once the worker reports it done
+    _args.finish_jobs = 0
+    _args.remove_from_playlist = False
+
+    # workers already rip in parallel, encode right away
+    _args.spool = False
+    return _args
+
+
+def run_worker(worker_id, args, work_queue, result_queue):
+    """entry point of a worker process"""
+    init_util_globals(args)
+
+    log_file = open(args.log[0], 'a')
+    sys.stdout = AnsiToWin32(log_file, strip=True).stream
+
+    # the supervisor decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    ripper = Ripper(args)
+    ripper.worker = Worker(worker_id, ripper, work_queue, result_queue)
+
+    def terminate(signum, frame):
+        ripper.abort_rip()
+    signal.signal(signal.SIGTERM, terminate)
+
+    ripper.start()
+    if ripper.login():
+        result_queue.put(("ready", worker_id, None))
+    else:
+        print(Fore.RED + "Could not login using the credentials in " +
+              args.settings[0] + Fore.RESET)
+        result_queue.put(("login_failed", worker_id, None))
+        ripper.abort_rip()
+    ripper.ripper_continue.set()
+
+    while ripper.isAlive():
+        ripper.join(0.1)
+
+
+class Worker(object):
+    """Rips the tracks a worker process pulls from the shared work queue"""
+
+    def __init__(self, worker_id, ripper, work_queue, result_queue):
+        self.worker_id = worker_id
+        self.ripper = ripper
+        self.work_queue = work_queue
+        self.result_queue = result_queue
+        self.sources = {}
+
+        # (position, item) of the tracks we still have to report, by URI
+        self.unreported = {}
+
+    def load_source(self, source_uri):
+        """the playlist/album/chart a track came from is only needed if
+        the comment or grouping tags refer to it"""
+        args = self.ripper.args
+        ripper = self.ripper
+
+        source = self.sources.get(source_uri)
+        if source is None:
+            source = ManifestSource(source_uri)
+            if source_uri is not None and (args.comment is not None or
+                                           args.grouping is not None):
+                ripper.get_tracks_from_uri(source_uri)
+                source.playlist = ripper.current_playlist
+                source.album = ripper.current_album
+                source.chart = ripper.current_chart
+            self.sources[source_uri] = source
+        return source
+
+    def load_item(self, work):
+        ripper = self.ripper
+        manifest = ripper.manifest
+
+        source = self.load_source(work["source_uri"])
+        track = ripper.session.get_track(work["uri"])
+
+        item = ManifestItem(source, work["idx"], track)
+        item.metadata = ripper.metadata.track(track)
+        item.audio_file = work["audio_file"]
+        item.partial = work["partial"]
+        item.available = True
+        item.resolved = True
+
+        manifest.clear()
+        item.position = 0
+        item.rip_position = 0
+        manifest.items.append(item)
+        manifest.rip_order.append(item)
+        manifest.activate(source)
+        return item
+
+    def report(self, uri, success):
+        entries = self.unreported.get(uri)
+        if not entries:
+            return
+        position, item = entries.pop(0)
+        if len(entries) == 0:
+            del self.unreported[uri]
+        self.result_queue.put(
+            ("done", self.worker_id, (position, success, item.pcm_hash)))
+
+    def logged(self, track, success):
+        """called for every success or failure logged by the ripper, so
+        a track is reported once it was actually encoded and tagged"""
+        self.report(track.link.uri, success)
+
+    def rip_work_queue(self):
+        ripper = self.ripper
+        ripper.post.listener = self.logged
+
+        while not ripper.abort.is_set():
+            try:
+                work = self.work_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if work is None:
+                break
+
+            self.result_queue.put(
+                ("start", self.worker_id, work["position"]))
+            try:
+                item = self.load_item(work)
+            except spotify.Error as e:
+                print(str(e))
+                self.result_queue.put(
+                    ("done", self.worker_id,
+                     (work["position"], False, None)))
+                continue
+
+            uri = item.track.link.uri
+            self.unreported.setdefault(uri, []).append(
+                (work["position"], item))
+            try:
+                success = ripper.rip_item(item)
+            except spotify.Error as e:
+                print(str(e))
+                success = False
+
+            # a track that was not handed on for finishing is done here,
+            # no-op if the ripper logged it already
+            if not success:
+                self.report(uri, False)
+            elif item.skip:
+                self.report(uri, True)
+
+        # spooled tracks may still be encoding
+        ripper.wait_finished()
+        for uri in list(self.unreported.keys()):
+            while uri in self.unreported:
+                self.report(uri, False)
+
+
+class Supervisor(object):
+    """Shards the ripping of a manifest across several worker processes,
+    each logged in with its own Spotify account and settings directory.
+
+    The supervisor resolves the URIs itself and takes care of skipping,
+    playlist files, removing tracks from playlists, the fail log and the
+    summary. Workers only capture, encode and tag the tracks they pull
+    from the shared work queue.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.settings_dirs = [norm_path(d) for d in args.workers]
+        self.work_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.processes = []
+
+    def start(self):
+        """start the workers, needs to be called before our own
+        libspotify session is created"""
+        for worker_id, settings_dir in enumerate(self.settings_dirs, 1):
+            if not path_exists(settings_dir):
+                os.makedirs(enc_str(settings_dir))
+
+            process = multiprocessing.Process(
+                target=run_worker,
+                name="SpotifyRipperWorker-" + str(worker_id),
+                args=(worker_id, worker_args(self.args, settings_dir),
+                      self.work_queue, self.result_queue))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        print(Fore.YELLOW + "  Workers:\t\t" + Fore.RESET +
+              str(len(self.processes)))
+
+    def stop(self, abort=False):
+        for process in self.processes:
+            if abort:
+                process.terminate()
+            else:
+                self.work_queue.put(None)
+        for process in self.processes:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def workers_alive(self):
+        return any(process.is_alive() for process in self.processes)
+
+    def rip_manifest(self, ripper):
+        args = self.args
+        manifest = ripper.manifest
+        post = ripper.post
+
+        succeeded = set()
+        pending = {}
+        dispatched_paths = set()
+
+        for item in manifest.rip_order:
+            if ripper.abort.is_set():
+                break
+
+            track = item.track
+            try:
+                if not item.resolved:
+                    manifest.resolve_item(item)
+                    manifest.check_existing(item)
+            except spotify.Error as e:
+                print(str(e))
+                post.log_failure(track)
+                continue
+
+            if not item.available:
+                print(Fore.RED + "Track is not available, skipping " +
+                      track.link.uri + Fore.RESET)
+                post.log_failure(track)
+                continue
+
+            if item.skip or (not args.overwrite and
+                             (item.audio_file in manifest.ripped_paths or
+                              item.audio_file in dispatched_paths)):
+                succeeded.add(item.position)
+                continue
+
+            if item.reuse_file is not None and ripper.reuse_existing(item):
+                succeeded.add(item.position)
+                continue
+
+            source_uri = item.source.uri \
+                if not isinstance(item.source.uri, list) else None
+            self.work_queue.put({
+                "position": item.position,
+                "uri": item.metadata.uri,
+                "idx": item.idx,
+                "audio_file": item.audio_file,
+                "partial": item.partial,
+                "source_uri": source_uri
+            })
+            pending[item.position] = item
+            dispatched_paths.add(item.audio_file)
+
+        total = len(pending)
+        done = 0
+        while len(pending) > 0 and not ripper.abort.is_set():
+            try:
+                message, worker_id, data = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                if not self.workers_alive():
+                    print(Fore.RED + "All workers have exited" + Fore.RESET)
+                    break
+                continue
+
+            worker_str = "Worker " + str(worker_id)
+            if message == "login_failed":
+                print(Fore.RED + worker_str + " could not login, see " +
+                      self.settings_dirs[worker_id - 1] + Fore.RESET)
+            elif message == "start":
+                item = pending.get(data)
+                if item is not None:
+                    print(Fore.GREEN + "[ " + str(done + 1) + " / " +
+                          str(total) + " ] " + worker_str + " ripping " +
+                          item.metadata.uri + Fore.RESET)
+                    print(Fore.CYAN + item.audio_file + Fore.RESET)
+            elif message == "done":
+                position, success, pcm_hash = data
+                item = pending.pop(position, None)
+                if item is None:
+                    continue
+                done += 1
+                if success:
+                    print(Fore.GREEN + worker_str + " ripped " +
+                          item.metadata.uri + Fore.RESET)
+                    succeeded.add(position)
+                    manifest.ripped_paths.add(item.audio_file)
+                    ripper.registry.record(item.metadata.uri,
+                                           item.audio_file,
+                                           item.metadata.duration, pcm_hash)
+                    ripper.journal.mark(item.metadata.uri, item.audio_file,
+                                        ripper.journal.DONE)
+                    post.log_success(item.track)
+                else:
+                    print(Fore.RED + worker_str + " failed to rip " +
+                          item.metadata.uri + Fore.RESET)
+                    post.log_failure(item.track)
+
+        # anything left over was not ripped
+        for item in pending.values():
+            post.log_failure(item.track)
+
+        for source in manifest.sources:
+            manifest.activate(source)
+
+            for item in source.items:
+                if item.position in succeeded:
+                    post.queue_remove_from_playlist(item.idx)
+
+            post.create_playlist_m3u(source.items)
+            post.create_playlist_wpl(source.items)
+            post.remove_tracks_from_playlist()
+            post.remove_offline_cache()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.tags import set_metadata_tags
+import threading
+
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+
+class FinishJob(object):
+    """A captured track whose encoders still have to be drained, with the
+    options it was ripped with"""
+
+    def __init__(self, item, sink, extra_files, args):
+        self.item = item
+        self.sink = sink
+        self.extra_files = extra_files
+        self.args = args
+
+
+class Finisher(object):
+    """Drains the encoders of a captured track, tags its files and does
+    the bookkeeping in a few background threads, so the ripper loads the
+    next track as soon as the last frame of this one was delivered. With
+    no threads every track is finished right away on the ripper thread"""
+
+    def __init__(self, args, ripper):
+        self.args = args
+        self.ripper = ripper
+        self.num_threads = args.finish_jobs
+        self.jobs = queue.Queue()
+        self.pending = 0
+        self.cond = threading.Condition()
+        self.threads = []
+
+        for i in range(self.num_threads):
+            thread = threading.Thread(target=self.finish_loop,
+                                      name="SpotifyFinisher" + str(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, job):
+        if len(self.threads) == 0:
+            self.finish(job)
+            return
+        with self.cond:
+            self.pending += 1
+        self.jobs.put(job)
+
+    def finish_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                self.finish(job)
+            finally:
+                with self.cond:
+                    self.pending -= 1
+                    self.cond.notify_all()
+
+    def wait(self):
+        """wait until every submitted track is finished, e.g. before the
+        playlist files of a source are written"""
+        with self.cond:
+            if self.pending > 0:
+                print(Fore.YELLOW + "Waiting for " + str(self.pending) +
+                      " tracks to finish..." + Fore.RESET)
+            while self.pending > 0:
+                self.cond.wait(1)
+
+    def stop(self):
+        self.wait()
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def finish(self, job):
+        args = job.args
+        ripper = self.ripper
+        item = job.item
+        track = item.track
+        uri = track.link.uri
+
+        try:
+            # waits for the encoders to end
+            ripper.close_sink(job.sink)
+
+            # the same audio may be in the library under another URI
+            if args.dedup_audio and \
+                    ripper.reuse_captured(item, job.extra_files, args):
+                ripper.post.log_success(track)
+                return
+
+            ripper.journal.mark(uri, item.audio_file, ripper.journal.ENCODED)
+
+            # update id3v2 with metadata and embed front cover image
+            set_metadata_tags(args, item.audio_file, item.idx, track, ripper)
+            ripper.finish_extra_outputs(item.idx, track, job.extra_files,
+                                        item.pcm_hash, args)
+            ripper.journal.mark(uri, item.audio_file, ripper.journal.TAGGED)
+            ripper.registry.record(uri, item.audio_file, track.duration,
+                                   item.pcm_hash)
+            ripper.journal.mark(uri, item.audio_file, ripper.journal.DONE)
+        except Exception as e:
+            print(Fore.RED + "Could not finish " + item.audio_file +
+                  Fore.RESET)
+            print(str(e))
+            rm_file(item.audio_file)
+            for output, audio_file in job.extra_files:
+                rm_file(audio_file)
+            ripper.manifest.ripped_paths.discard(item.audio_file)
+            ripper.post.log_failure(track)
+            return
+
+        ripper.post.log_success(track)
+
+        # make a note of the index and remove all the
+        # tracks from the playlist when everything is done
+        ripper.post.queue_remove_from_playlist(item.idx)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import re
+
+# ionice class and level for each --encoder-ionice setting
+ionice_classes = {
+    "low": ["-c", "2", "-n", "7"],
+    "idle": ["-c", "3"],
+}
+
+
+def parse_cpu_list(cpu_list):
+    """returns the set of CPUs in a list like "0-3,6", raises ValueError
+    if it is not valid"""
+    cpus = set()
+    for token in cpu_list.split(","):
+        match = re.match(r"^\s*(\d+)\s*(?:-\s*(\d+)\s*)?$", token)
+        if match is None:
+            raise ValueError("'" + token + "' is not a CPU or CPU range")
+        first = int(match.group(1))
+        last = int(match.group(2)) if match.group(2) is not None else first
+        if last < first:
+            raise ValueError("'" + token + "' is not a CPU range")
+        cpus.update(range(first, last + 1))
+    return cpus
+
+
+def governor_tools(args):
+    """the external programs needed for the --encoder-* settings"""
+    tools = []
+    if args.encoder_nice != 0:
+        tools.append("nice")
+    if args.encoder_ionice != "normal":
+        tools.append("ionice")
+    if args.encoder_cpus is not None:
+        tools.append("taskset")
+    return tools
+
+
+def governed_command(args, command):
+    """prefixes an encoder command line with nice, ionice and taskset so
+    the encoder runs with the configured priority and CPU affinity. The
+    tools exec the encoder, so it keeps their process id"""
+    if command is None:
+        return None
+    prefix = []
+    if args.encoder_cpus is not None:
+        prefix.extend(["taskset", "-c", args.encoder_cpus])
+    if args.encoder_ionice != "normal":
+        prefix.extend(["ionice"] + ionice_classes[args.encoder_ionice])
+    if args.encoder_nice != 0:
+        prefix.extend(["nice", "-n", str(args.encoder_nice)])
+    return prefix + command
+
+
+def load_allows(args, running):
+    """returns True if another background encoder may start while
+    `running` are already encoding. One is always allowed, more only while
+    the load average is below --encoder-max-load"""
+    if args.encoder_max_load <= 0 or running == 0:
+        return True
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return True
+
+    # the load average lags behind, but our own encoders count at least,
+    # another one adds about 1
+    return max(load, running) + 1 <= args.encoder_max_load
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+import os
+import time
+import sqlite3
+import threading
+
+
+class RipJournal(object):
+    """Write-ahead journal of the state of every track we rip, kept in
+    the settings directory.
+
+    Each track moves through queued, capturing, encoded, tagged and done.
+    A restarted run skips tracks that are done without opening their
+    files again and only re-checks the tracks that were in flight when
+    the previous run died.
+    """
+
+    QUEUED = "queued"
+    CAPTURING = "capturing"
+    ENCODED = "encoded"
+    TAGGED = "tagged"
+    DONE = "done"
+
+    in_flight = [CAPTURING, ENCODED, TAGGED]
+
+    def __init__(self, args):
+        self.args = args
+        self._lock = threading.RLock()
+        self._db = None
+        self.open()
+
+    def db_path(self):
+        return os.path.join(settings_dir(), "journal.db")
+
+    def open(self):
+        db_path = self.db_path()
+        try:
+            if not path_exists(os.path.dirname(db_path)):
+                os.makedirs(enc_str(os.path.dirname(db_path)))
+            self._db = sqlite3.connect(enc_str(db_path),
+                                       check_same_thread=False)
+
+            # every transition is committed right away, the WAL keeps
+            # that cheap while still surviving a crash
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS journal ("
+                "path TEXT PRIMARY KEY, uri TEXT NOT NULL, "
+                "output_type TEXT NOT NULL, state TEXT NOT NULL, "
+                "updated REAL NOT NULL)")
+            self._db.commit()
+        except sqlite3.Error as e:
+            print(Fore.YELLOW + "Warning: could not open rip journal " +
+                  db_path + Fore.RESET)
+            print(str(e))
+            self._db = None
+
+    def close(self):
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                self._db.commit()
+                self._db.close()
+            except sqlite3.Error as e:
+                print(Fore.YELLOW + "Warning: error while saving rip "
+                      "journal" + Fore.RESET)
+                print(str(e))
+            self._db = None
+
+    def state(self, uri, audio_file):
+        """returns the last recorded state of uri ripped to audio_file"""
+        with self._lock:
+            if self._db is None:
+                return None
+            try:
+                row = self._db.execute(
+                    "SELECT state FROM journal WHERE path = ? AND uri = ? "
+                    "AND output_type = ?",
+                    (audio_file, uri, self.args.output_type)).fetchone()
+            except sqlite3.Error as e:
+                print(str(e))
+                return None
+            return row[0] if row is not None else None
+
+    def mark(self, uri, audio_file, state):
+        self.mark_many([(uri, audio_file)], state)
+
+    def mark_many(self, entries, state):
+        """record the state of a list of (uri, audio_file) in a single
+        transaction"""
+        with self._lock:
+            if self._db is None or len(entries) == 0:
+                return
+            now = time.time()
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO journal "
+                    "(path, uri, output_type, state, updated) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(audio_file, uri, self.args.output_type, state, now)
+                     for uri, audio_file in entries])
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(Fore.YELLOW + "Warning: could not update rip "
+                      "journal" + Fore.RESET)
+                print(str(e))
+
+    def forget(self, audio_file):
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                self._db.execute("DELETE FROM journal WHERE path = ?",
+                                 (audio_file,))
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(str(e))
@@ -5,6 +5,13 @@ from __future__ import unicode_literals
 
 from colorama import init, Fore, AnsiToWin32
 from spotify_ripper.ripper import Ripper
+from spotify_ripper.farm import Supervisor
+from spotify_ripper.daemon import JobServer
+from spotify_ripper.outputs import OutputSpec
+from spotify_ripper.analysis import np
+from spotify_ripper.governor import parse_cpu_list, governor_tools
+from spotify_ripper.encoders import select_backends, native_backend, \
+    pick_backend
 from spotify_ripper.utils import *
 import os
 import sys
@@ -120,6 +127,22 @@ def main(prog_args=sys.argv[1:]):
         "comp": "10",
         "vbr": "0",
         "partial_check": "weak",
+        "prefetch": "3",
+        "metadata_cache_ttl": "7",
+        "metadata_cache_size": "100000",
+        "uri_chunk_size": "0",
+        "reuse_existing": "link",
+        "rip_order": "original",
+        "encode_jobs": "0",
+        "finish_jobs": "1",
+        "encoder_nice": "0",
+        "encoder_ionice": "normal",
+        "encoder_max_load": "0",
+        "dropout_check": "warn",
+        "dropout_retries": "2",
+        "stall_timeout": "5",
+        "stall_min_rate": "0.1",
+        "stall_retries": "2",
     }
     defaults = load_config(defaults)
 
@@ -196,12 +219,74 @@ def main(prog_args=sys.argv[1:]):
     parser.add_argument(
         '--cover-file-and-embed', nargs=1, metavar="COVER_FILE",
         help='Same as --cover-file but embeds the cover image too')
+    parser.add_argument(
+        '--daemon', type=int, metavar="PORT",
+        help='Stay logged in and rip jobs submitted as JSON to '
+             'http://127.0.0.1:PORT/jobs instead of ripping URIs given on '
+             'the command line. Jobs can set their own format, directory '
+             'and overwrite options and stream their status back. '
+             'Requests need the token of the daemon_token file in the '
+             'settings directory (see README)')
+    parser.add_argument(
+        '--dedup-audio', action='store_true',
+        help='If the audio of a track that was just captured is identical '
+             'to a file in the rip registry (e.g. the same recording on a '
+             'compilation), copy that file (a reflink when the file '
+             'system supports it) instead of keeping a second encode. '
+             'The copy is tagged for the new track')
     parser.add_argument(
         '-d', '--directory', nargs=1,
         help='Base directory where ripped MP3s are saved [Default=cwd]')
+    parser.add_argument(
+        '--dropout-check', choices=['off', 'warn', 'rerip'],
+        help='Check the captured audio for gaps of digital silence and '
+             'truncation caused by network dropouts (gap detection needs '
+             'NumPy). "warn" prints a warning, "rerip" rips the track again '
+             'right away [Default=warn]')
+    parser.add_argument(
+        '--dropout-retries', type=int, metavar="NUM_RETRIES",
+        help='Number of times a track is ripped again with --dropout-check '
+             'rerip [Default=2]')
+    parser.add_argument(
+        '--encode-jobs', type=int, metavar="NUM_JOBS",
+        help='Number of processes that encode spooled tracks (see '
+             '--spool) [Default=number of CPUs]')
+    parser.add_argument(
+        '--encoder-cpus', metavar="CPU_LIST",
+        help='Run the encoders only on these CPUs, e.g. "2-7" or "0,2,4" '
+             '(requires taskset) [Default=all]')
+    parser.add_argument(
+        '--encoder-ionice', choices=['normal', 'low', 'idle'],
+        help='I/O priority of the encoders, "low" is the lowest best-effort '
+             'level and "idle" only gets disk time no one else wants '
+             '(requires ionice) [Default=normal]')
+    parser.add_argument(
+        '--encoder-max-load', type=float, metavar="LOAD",
+        help='With --spool, only start another encoder while the load '
+             'average stays below LOAD, 0 starts up to --encode-jobs '
+             'encoders regardless of load [Default=0]')
+    parser.add_argument(
+        '--encoder-nice', type=int, metavar="NICE",
+        help='Niceness the encoders run with, e.g. 10 to leave CPU time '
+             'to other services on the host [Default=0]')
+    parser.add_argument(
+        '--extra-output', action='append', dest='extra_outputs',
+        metavar='OUTPUT',
+        help='Also encode every ripped track to another output type from '
+             'the same capture, given as TYPE[;OPTION=VALUE...]. TYPE is '
+             'one of mp3, flac, vorbis, opus, aac, mp4, alac, wav or pcm '
+             'and the options format, directory, bitrate, vbr, comp and cbr '
+             'can be set per output, e.g. "mp3;vbr=2;directory=/music/mob". '
+             'Can be given several times')
     parser.add_argument(
         '--fail-log', nargs=1,
         help="Logs the list of track URIs that failed to rip")
+    parser.add_argument(
+        '--finish-jobs', type=int, metavar="NUM_JOBS",
+        help='Number of threads that wait for the encoders and tag ripped '
+             'tracks in the background while the next track is captured, '
+             '0 finishes every track before the next one is loaded '
+             '[Default=1]')
     encoding_group.add_argument(
         '--flac', action='store_true',
         help='Rip songs to lossless FLAC encoding instead of MP3')
@@ -248,6 +333,14 @@ def main(prog_args=sys.argv[1:]):
     parser.add_argument(
         '-L', '--log', nargs=1,
         help='Log in a log-friendly format to a file (use - to log to stdout)')
+    parser.add_argument(
+        '--metadata-cache-ttl', type=int, metavar="DAYS",
+        help='Number of days track and album metadata is cached in the '
+             'settings directory. Use 0 to disable the cache [Default=7]')
+    parser.add_argument(
+        '--metadata-cache-size', type=int, metavar="NUM_ENTRIES",
+        help='Maximum number of tracks and albums kept in the metadata '
+             'cache [Default=100000]')
     encoding_group.add_argument(
         '--pcm', action='store_true',
         help='Saves a .pcm file with the raw PCM data instead of MP3')
@@ -273,6 +366,11 @@ def main(prog_args=sys.argv[1:]):
         help='Check for and overwrite partially ripped files. "weak" will '
              'err on the side of not re-ripping the file if it is unsure, '
              'whereas "strict" will re-rip the file [Default=weak]')
+    parser.add_argument(
+        '--prefetch', type=int, metavar="NUM_TRACKS",
+        help='Number of upcoming tracks whose metadata, album, cover image '
+             'and genres are loaded in the background while ripping. '
+             'Use 0 to disable [Default=3]')
     parser.add_argument(
         '--play-token-resume', metavar="RESUME_AFTER",
         help='If the \'play token\' is lost to a different device using '
@@ -298,21 +396,62 @@ def main(prog_args=sys.argv[1:]):
         '--remove-offline-cache', action='store_true',
         help='Remove libspotify\'s offline cache directory after the rip'
              'is complete to save disk space')
+    parser.add_argument(
+        '--replaygain', action='store_true',
+        help='Measure the loudness (EBU R128) and peak of every track while '
+             'it is ripped and write ReplayGain 2.0 track gain tags, plus '
+             'album gain tags when ripping an album URI. Opus files get '
+             'R128 gain tags instead (needs NumPy)')
     parser.add_argument(
         '--resume-after',
         help='Resumes script after a certain amount of time has passed '
              'after stopping (e.g. 1h30m). Alternatively, accepts a specific '
              'time in 24hr format to start after (e.g 03:30, 16:15). '
              'Requires --stop-after option to be set')
+    parser.add_argument(
+        '--reuse-existing', choices=['link', 'copy', 'none'],
+        help='If a track was already ripped to a different path (e.g. with '
+             'another format string or from another playlist), hardlink '
+             '("link") or copy ("copy") that file instead of ripping the '
+             'track again. Copies use a reflink when the file system '
+             'supports it [Default=link]')
     parser.add_argument(
         '-R', '--replace', nargs="+", required=False,
         help='pattern to replace the output filename separated by "/". '
              'The following example replaces all spaces with "_" and all "-" '
              'with ".":'
              '    spotify-ripper --replace " /_" "\-/." uri')
+    parser.add_argument(
+        '--rip-order', choices=['original', 'album', 'shortest'],
+        help='Order in which the tracks of each URI are ripped, '
+             'consecutive single track URIs are ordered as one list. '
+             '"album" rips the tracks of an album together (by disc and track '
+             'number) so album metadata and covers are only fetched once, '
+             '"shortest" rips the shortest tracks first. Playlist files and '
+             '{idx} always use the playlist order [Default=original]')
     parser.add_argument(
         '-s', '--strip-colors', action='store_true',
         help='Strip coloring from output [Default=colors]')
+    parser.add_argument(
+        '--spool', action='store_true',
+        help='Capture tracks to raw PCM files in the settings directory '
+             'and encode them in the background with --encode-jobs '
+             'processes, so the next track is captured while the previous '
+             'ones are encoded')
+    parser.add_argument(
+        '--stall-timeout', type=float, metavar="SECONDS",
+        help='Consider the stream stalled if no audio was delivered for '
+             'this many seconds, the track is then loaded and ripped again '
+             '[Default=5]')
+    parser.add_argument(
+        '--stall-min-rate', type=float, metavar="RATIO",
+        help='Also consider the stream stalled if audio is delivered at '
+             'less than this ratio of real time over twice --stall-timeout '
+             '[Default=0.1]')
+    parser.add_argument(
+        '--stall-retries', type=int, metavar="NUM_RETRIES",
+        help='Number of times a stalled track is ripped again before '
+             'giving up on it [Default=2]')
     parser.add_argument(
         '--stereo-mode', choices=['j', 's', 'f', 'd', 'm', 'l', 'r'],
         help='Advanced stereo settings for Lame MP3 encoder only')
@@ -321,6 +460,11 @@ def main(prog_args=sys.argv[1:]):
         help='Stops script after a certain amount of time has passed '
              '(e.g. 1h30m). Alternatively, accepts a specific time in 24hr '
              'format to stop after (e.g 03:30, 16:15)')
+    parser.add_argument(
+        '--uri-chunk-size', type=int, metavar="NUM_URIS",
+        help='Resolve and rip a file of URIs in chunks of this many URIs '
+             'instead of resolving the whole file before ripping. The total '
+             'progress is then shown per chunk [Default=0 (whole file)]')
     parser.add_argument(
         '-V', '--version', action='version', version=prog_version)
     encoding_group.add_argument(
@@ -329,17 +473,27 @@ def main(prog_args=sys.argv[1:]):
     encoding_group.add_argument(
         '--vorbis', action='store_true',
         help='Rip songs to Ogg Vorbis encoding instead of MP3')
+    parser.add_argument(
+        '--worker', action='append', dest='workers',
+        metavar='SETTINGS_DIR',
+        help='Rip with an additional worker process that logs in with the '
+             'last credentials used with this settings directory (see -S). '
+             'Can be given several times to rip several streams at once; '
+             'progress and summaries are merged into this process')
     parser.add_argument(
         '-r', '--remove-from-playlist', action='store_true',
         help='Delete tracks from playlist after successful '
              'ripping [Default=no]')
     parser.add_argument(
-        'uri', nargs="+",
+        'uri', nargs="*",
         help='One or more Spotify URI(s) (either URI, a file of URIs or a '
              'search query)')
     args = parser.parse_args(remaining_argv)
     init_util_globals(args)
 
+    if len(args.uri) == 0 and args.daemon is None:
+        parser.error("the following arguments are required: uri")
+
     # kind of a hack to get colorama stripping to work when outputting
     # to a file instead of stdout.  Taken from initialise.py in colorama
     def wrap_stream(stream, convert, strip, autoreset, wrap):
@@ -404,26 +558,45 @@ def main(prog_args=sys.argv[1:]):
     else:
         args.output_type = "mp3"
 
-    # check that encoder tool is available
-    encoders = {
-        "flac": ("flac", "flac"),
-        "aac": ("faac", "faac"),
-        "ogg": ("oggenc", "vorbis-tools"),
-        "opus": ("opusenc", "opus-tools"),
-        "mp3": ("lame", "lame"),
-        "m4a": ("fdkaac", "fdk-aac-encoder"),
-        "alac.m4a": ("avconv", "libav-tools"),
-    }
-    if args.output_type in encoders.keys():
-        encoder = encoders[args.output_type][0]
-        if which(encoder) is None:
-            print(Fore.RED + "Missing dependency '" + encoder +
-                  "'.  Please install and add to path..." + Fore.RESET)
-            # assumes OS X or Ubuntu/Debian
-            command_help = ("brew install " if sys.platform == "darwin"
-                            else "sudo apt-get install ")
-            print("...try " + Fore.YELLOW + command_help +
-                  encoders[args.output_type][1] + Fore.RESET)
+    # additional output types the captured PCM is teed into
+    extra_outputs = []
+    for spec in (args.extra_outputs or []):
+        try:
+            extra_outputs.append(OutputSpec.parse(spec))
+        except ValueError as e:
+            print(Fore.RED + "--extra-output " + spec + " is not valid: " +
+                  str(e) + Fore.RESET)
+            sys.exit(1)
+    args.extra_outputs = extra_outputs
+
+    # pick the fastest installed encoder of each output type, check that
+    # there is one at all
+    outputs = [(args.output_type, {})] + \
+        [(output.output_type, output.options)
+         for output in args.extra_outputs]
+    args.encoder_backends, missing = select_backends(args, outputs)
+    for output_type in missing:
+        backend = native_backend(output_type)
+        print(Fore.RED + "Missing dependency '" + backend.program +
+              "'.  Please install and add to path..." + Fore.RESET)
+        # assumes OS X or Ubuntu/Debian
+        command_help = ("brew install " if sys.platform == "darwin"
+                        else "sudo apt-get install ")
+        print("...try " + Fore.YELLOW + command_help +
+              backend.package + Fore.RESET)
+        sys.exit(1)
+
+    if args.encoder_cpus is not None:
+        try:
+            parse_cpu_list(args.encoder_cpus)
+        except ValueError as e:
+            print(Fore.RED + "--encoder-cpus is not valid: " + str(e) +
+                  Fore.RESET)
+            sys.exit(1)
+    for tool in governor_tools(args):
+        if which(tool) is None:
+            print(Fore.RED + "Missing dependency '" + tool + "' for the "
+                  "--encoder-* options" + Fore.RESET)
             sys.exit(1)
 
     # format string
@@ -467,6 +640,12 @@ def main(prog_args=sys.argv[1:]):
 
     print(Fore.YELLOW + "  Encoding output:\t" +
           Fore.RESET + encoding_output_str())
+    encoder = pick_backend(args, args.output_type)
+    if encoder is not None:
+        print(Fore.YELLOW + "  Encoder:\t\t" + Fore.RESET + encoder.name)
+    if len(args.extra_outputs) > 0:
+        print(Fore.YELLOW + "  Extra outputs:\t" + Fore.RESET +
+              ", ".join(output.name for output in args.extra_outputs))
     print(Fore.YELLOW + "  Spotify bitrate:\t" +
           Fore.RESET + args.quality + " kbps")
 
@@ -492,6 +671,25 @@ def main(prog_args=sys.argv[1:]):
         print(Fore.RED + "--play_token_resume option is not valid" + Fore.RESET)
         sys.exit(1)
 
+    if args.daemon is not None and args.workers is not None:
+        print(Fore.RED + "--daemon can not be used with --worker" + Fore.RESET)
+        sys.exit(1)
+    if args.dropout_check != "off" and np is None:
+        print(Fore.YELLOW + "NumPy is not installed, --dropout-check will "
+              "only look for truncated tracks" + Fore.RESET)
+    if args.dedup_audio and args.reuse_existing == "none":
+        print(Fore.RED + "--dedup-audio can not be used with "
+              "--reuse-existing none" + Fore.RESET)
+        sys.exit(1)
+    if args.replaygain and np is None:
+        print(Fore.RED + "--replaygain needs NumPy to be installed" +
+              Fore.RESET)
+        sys.exit(1)
+    if args.spool and len(args.extra_outputs) > 0:
+        print(Fore.RED + "--spool can not be used with --extra-output" +
+              Fore.RESET)
+        sys.exit(1)
+
     print(Fore.YELLOW + "  Unicode support:\t" +
           Fore.RESET + unicode_support_str())
     print(Fore.YELLOW + "  Output directory:\t" + Fore.RESET +
@@ -504,10 +702,21 @@ def main(prog_args=sys.argv[1:]):
           Fore.RESET + ("Yes" if args.overwrite else "No"))
 
     # patch a bug when Python 3/MP4
-    if sys.version_info >= (3, 0) and args.output_type == "m4a":
+    if sys.version_info >= (3, 0) and \
+            "m4a" in [output_type for output_type, options in outputs]:
         patch_bug_in_mutagen()
 
+    # worker processes need to be started before we create our own
+    # libspotify session
+    supervisor = None
+    if args.workers is not None:
+        supervisor = Supervisor(args)
+        supervisor.start()
+
     ripper = Ripper(args)
+    ripper.supervisor = supervisor
+    if args.daemon is not None:
+        ripper.job_server = JobServer(args, ripper)
     ripper.start()
 
     # try to listen for terminal resize events
@@ -533,8 +742,7 @@ def main(prog_args=sys.argv[1:]):
     # check if we were passed a file name or search
     def check_uri_args():
         if len(args.uri) == 1 and path_exists(args.uri[0]):
-            args.uri = [line.strip() for line in open(args.uri[0])
-                if not line.strip().startswith("#") and len(line.strip()) > 0]
+            args.uri = iter_uri_file(args.uri[0])
         elif len(args.uri) == 1 and not args.uri[0].startswith("spotify:"):
             args.uri = [list(ripper.search_query(args.uri[0]))]
 
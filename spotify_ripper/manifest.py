@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from spotify_ripper.utils import *
+from spotify_ripper.sync import Sync
+from spotify_ripper.scheduler import schedule
+import spotify
+
+
+class ManifestItem(object):
+    """A single track of the rip manifest and everything we resolved
+    about it before ripping started"""
+
+    def __init__(self, source, idx, track):
+        self.source = source
+        self.position = None
+        self.rip_position = None
+        self.idx = idx
+        self.track = track
+        self.metadata = None
+        self.audio_file = None
+        self.resolved = False
+        self.available = False
+        self.partial = False
+        self.skip = False
+        self.reuse_file = None
+        self.attempts = 0
+        self.stalls = 0
+        self.pcm_hash = None
+
+
+class ManifestSource(object):
+    """The tracks resolved from one URI together with the playlist,
+    album or chart they were loaded from. Consecutive URIs without any
+    of these (e.g. single tracks) share one source, uri is a list then"""
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.playlist = None
+        self.album = None
+        self.chart = None
+        self.items = []
+        self.rip_order = []
+
+
+class Manifest(object):
+    """Resolves every URI exactly once so that the size/ETA calculation,
+    playlist sync, ripping loop and playlist writers all share the same
+    loaded tracks and formatted paths"""
+
+    def __init__(self, args, ripper):
+        self.args = args
+        self.ripper = ripper
+        self.sources = []
+        self.items = []
+        self.rip_order = []
+
+        # paths that were ripped during this run
+        self.ripped_paths = set()
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def resolve(self, uris):
+        sources = []
+        for uri in uris:
+            if self.ripper.abort.is_set():
+                break
+            source = self.resolve_source(uri)
+
+            # tracks without a playlist or album of their own are
+            # scheduled together, so --rip-order works on a list of
+            # single track URIs too
+            if len(sources) > 0 and self.is_loose(source) and \
+                    self.is_loose(sources[-1]):
+                self.merge_sources(sources[-1], source)
+            else:
+                sources.append(source)
+
+        # the order we rip in, the playlist files keep the source order
+        for source in sources:
+            source.rip_order = schedule(self.args.rip_order, source.items)
+            for item in source.rip_order:
+                item.rip_position = len(self.rip_order)
+                self.rip_order.append(item)
+        self.sources.extend(sources)
+
+    def is_loose(self, source):
+        return source.playlist is None and source.album is None and \
+            source.chart is None
+
+    def merge_sources(self, source, other):
+        def uri_list(uri):
+            return uri if isinstance(uri, list) else [uri]
+        source.uri = uri_list(source.uri) + uri_list(other.uri)
+        for item in other.items:
+            item.source = source
+            source.items.append(item)
+
+    def resolve_source(self, uri):
+        args = self.args
+        ripper = self.ripper
+
+        source = ManifestSource(uri)
+        tracks = list(ripper.get_tracks_from_uri(uri))
+        source.playlist = ripper.current_playlist
+        source.album = ripper.current_album
+        source.chart = ripper.current_chart
+
+        for idx, track in enumerate(tracks):
+            item = ManifestItem(source, idx, track)
+            item.position = len(self.items)
+            source.items.append(item)
+            self.items.append(item)
+            try:
+                self.resolve_item(item)
+            except spotify.Error as e:
+                # we will try again once we get to the track
+                continue
+
+        # sync before checking for existing files since it may rename them
+        if args.playlist_sync and source.playlist:
+            ripper.sync = Sync(args, ripper)
+            ripper.sync.sync_playlist(source)
+
+        for item in source.items:
+            self.check_existing(item)
+
+        ripper.journal.mark_many(
+            [(item.metadata.uri, item.audio_file) for item in source.items
+             if item.available and not item.skip], ripper.journal.QUEUED)
+
+        return source
+
+    def resolve_item(self, item):
+        metadata = self.ripper.metadata.track(item.track)
+        item.metadata = metadata
+        item.available = metadata.availability == 1 and not metadata.is_local
+        if item.available:
+            item.audio_file = \
+                self.ripper.format_track_path(item.idx, item.track)
+        item.resolved = True
+
+    def check_existing(self, item):
+        registry = self.ripper.registry
+        journal = self.ripper.journal
+        item.partial = False
+        item.skip = False
+        item.reuse_file = None
+        if not item.available or self.args.overwrite:
+            return
+
+        uri = item.metadata.uri
+        state = journal.state(uri, item.audio_file)
+        if state == journal.DONE:
+            # no need to open the file again, just make sure it is there
+            if path_exists(item.audio_file):
+                item.skip = True
+                return
+            journal.forget(item.audio_file)
+        elif state in journal.in_flight:
+            # we died while ripping this one
+            item.partial = path_exists(item.audio_file)
+        elif path_exists(item.audio_file):
+            if is_partial(item.audio_file, item.metadata):
+                item.partial = True
+            else:
+                item.skip = True
+                registry.record(uri, item.audio_file, item.metadata.duration)
+                journal.mark(uri, item.audio_file, journal.DONE)
+                return
+
+        # we may have ripped this track to a different path before
+        item.reuse_file = registry.find(uri, item.audio_file)
+
+    def upcoming(self, item, count):
+        """returns up to count items after item that still need ripping"""
+        upcoming = []
+        for next_item in self.rip_order[item.rip_position + 1:]:
+            if len(upcoming) >= count:
+                break
+            if next_item.resolved and next_item.available and \
+                    not next_item.skip and next_item.reuse_file is None:
+                upcoming.append(next_item)
+        return upcoming
+
+    def clear(self):
+        """forget the resolved sources, but remember what was ripped"""
+        self.sources = []
+        self.items = []
+        self.rip_order = []
+
+    def activate(self, source):
+        """restore the playlist/album/chart context of source on
+        the ripper"""
+        ripper = self.ripper
+        ripper.current_playlist = source.playlist
+        ripper.current_album = source.album
+        ripper.current_chart = source.chart
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+import os
+import time
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class TrackMetadata(object):
+    """Snapshot of the track metadata we need for formatting and tagging"""
+
+    fields = ["uri", "name", "artists", "artist_uris", "album", "album_uri",
+              "year", "index", "disc", "duration", "availability",
+              "is_local"]
+
+    def __init__(self, data):
+        for field in self.fields:
+            setattr(self, field, data.get(field))
+
+    @classmethod
+    def from_track(cls, track):
+        track.load()
+        album = track.album
+        album.load()
+        return cls({
+            "uri": track.link.uri,
+            "name": track.name,
+            "artists": [artist.name for artist in track.artists],
+            "artist_uris": [artist.link.uri for artist in track.artists],
+            "album": album.name,
+            "album_uri": album.link.uri,
+            "year": album.year,
+            "index": track.index,
+            "disc": track.disc,
+            "duration": track.duration,
+            "availability": int(track.availability),
+            "is_local": track.is_local
+        })
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+
+class AlbumMetadata(object):
+    """Snapshot of an album browse result with a precomputed disc/track
+    layout"""
+
+    fields = ["uri", "tracks", "copyrights"]
+
+    def __init__(self, data):
+        for field in self.fields:
+            setattr(self, field, data.get(field))
+
+        # highest track number on each disc
+        self.disc_tracks = {}
+        for disc, index in self.tracks:
+            if index > self.disc_tracks.get(disc, 0):
+                self.disc_tracks[disc] = index
+        self.num_discs = max(self.disc_tracks.keys()) \
+            if len(self.disc_tracks) > 0 else 0
+
+    def num_tracks(self, disc):
+        return self.disc_tracks.get(disc, 0)
+
+    @classmethod
+    def from_browser(cls, album, album_browser):
+        return cls({
+            "uri": album.link.uri,
+            "tracks": [[t.disc, t.index] for t in album_browser.tracks],
+            "copyrights": list(album_browser.copyrights)
+        })
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+
+class LRUCache(object):
+    """Small in-memory least recently used cache"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.pop(key, None)
+        if value is not None:
+            self._items[key] = value
+        return value
+
+    def put(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+
+class MetadataCache(object):
+    """Track and album metadata, kept in memory for the current run and
+    persisted to a SQLite database in the settings directory so that
+    later runs do not have to load everything from libspotify again"""
+
+    commit_interval = 100
+    track_cache_size = 10000
+    album_cache_size = 256
+
+    def __init__(self, args, ripper):
+        self.args = args
+        self.ripper = ripper
+        self.ttl = max(args.metadata_cache_ttl, 0) * 24 * 60 * 60
+        self.max_entries = max(args.metadata_cache_size, 0)
+
+        self._lock = threading.RLock()
+        self._tracks = LRUCache(self.track_cache_size)
+        self._albums = LRUCache(self.album_cache_size)
+        self._accessed = set()
+        self._pending = 0
+        self._db = None
+
+        if self.ttl > 0 and self.max_entries > 0:
+            self.open()
+
+    def db_path(self):
+        return os.path.join(settings_dir(), "metadata.db")
+
+    def open(self):
+        db_path = self.db_path()
+        try:
+            if not path_exists(os.path.dirname(db_path)):
+                os.makedirs(enc_str(os.path.dirname(db_path)))
+            self._db = sqlite3.connect(enc_str(db_path),
+                                       check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS metadata ("
+                "uri TEXT PRIMARY KEY, data TEXT NOT NULL, "
+                "updated REAL NOT NULL, accessed REAL NOT NULL)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS metadata_accessed "
+                "ON metadata (accessed)")
+            self.evict()
+        except sqlite3.Error as e:
+            print(Fore.YELLOW + "Warning: could not open metadata cache " +
+                  db_path + Fore.RESET)
+            print(str(e))
+            self._db = None
+
+    def close(self):
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                self.touch()
+                self.evict()
+                self._db.close()
+            except sqlite3.Error as e:
+                print(Fore.YELLOW + "Warning: error while saving metadata "
+                      "cache" + Fore.RESET)
+                print(str(e))
+            self._db = None
+
+    def evict(self):
+        """remove expired entries and the least recently used entries
+        over the size limit"""
+        with self._lock:
+            now = time.time()
+            self._db.execute("DELETE FROM metadata WHERE updated < ?",
+                             (now - self.ttl,))
+            count = self._db.execute(
+                "SELECT COUNT(*) FROM metadata").fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute(
+                    "DELETE FROM metadata WHERE uri IN (SELECT uri FROM "
+                    "metadata ORDER BY accessed ASC LIMIT ?)",
+                    (count - self.max_entries,))
+            self._db.commit()
+
+    def touch(self):
+        """update the access time of all entries read during this run"""
+        with self._lock:
+            if len(self._accessed) > 0:
+                now = time.time()
+                self._db.executemany(
+                    "UPDATE metadata SET accessed = ? WHERE uri = ?",
+                    [(now, uri) for uri in self._accessed])
+                self._accessed.clear()
+            self._db.commit()
+
+    def load_entry(self, uri):
+        with self._lock:
+            if self._db is None:
+                return None
+            try:
+                row = self._db.execute(
+                    "SELECT data FROM metadata WHERE uri = ? AND "
+                    "updated >= ?", (uri, time.time() - self.ttl)).fetchone()
+            except sqlite3.Error as e:
+                return None
+            if row is None:
+                return None
+            self._accessed.add(uri)
+            return json.loads(row[0])
+
+    def save_entry(self, uri, data):
+        with self._lock:
+            if self._db is None:
+                return
+            now = time.time()
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO metadata "
+                    "(uri, data, updated, accessed) VALUES (?, ?, ?, ?)",
+                    (uri, json.dumps(data), now, now))
+                self._pending += 1
+                if self._pending >= self.commit_interval:
+                    self._pending = 0
+                    self._db.commit()
+            except sqlite3.Error as e:
+                print(Fore.YELLOW + "Warning: could not save metadata for " +
+                      uri + Fore.RESET)
+                print(str(e))
+
+    def track(self, track):
+        """returns the TrackMetadata for a pyspotify track, only loading
+        the track from libspotify if it is not cached"""
+        uri = track.link.uri
+        with self._lock:
+            metadata = self._tracks.get(uri)
+        if metadata is not None:
+            return metadata
+
+        data = self.load_entry(uri)
+        if data is not None:
+            metadata = TrackMetadata(data)
+        else:
+            metadata = TrackMetadata.from_track(track)
+            # availability is what decides if we rip a track, don't
+            # persist unavailable tracks in case that changes
+            if metadata.availability == 1 and not metadata.is_local:
+                self.save_entry(uri, metadata.to_dict())
+
+        with self._lock:
+            self._tracks.put(uri, metadata)
+        return metadata
+
+    def album(self, metadata):
+        """returns the AlbumMetadata of the track's album, only browsing
+        the album if it is not cached"""
+        uri = metadata.album_uri
+        with self._lock:
+            album_metadata = self._albums.get(uri)
+        if album_metadata is not None:
+            return album_metadata
+
+        data = self.load_entry(uri)
+        if data is not None:
+            album_metadata = AlbumMetadata(data)
+        else:
+            album = self.ripper.session.get_album(uri)
+            album.load()
+            album_browser = album.browse()
+            album_browser.load()
+            album_metadata = AlbumMetadata.from_browser(album, album_browser)
+            self.save_entry(uri, album_metadata.to_dict())
+
+        with self._lock:
+            self._albums.put(uri, album_metadata)
+        return album_metadata
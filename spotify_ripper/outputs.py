@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+
+# --extra-output type names and the output type they rip to
+output_types = {
+    "mp3": "mp3",
+    "flac": "flac",
+    "vorbis": "ogg",
+    "opus": "opus",
+    "aac": "aac",
+    "mp4": "m4a",
+    "alac": "alac.m4a",
+    "wav": "wav",
+    "pcm": "pcm",
+}
+
+# same defaults as the encoding options of the main output
+default_settings = {
+    "bitrate": "320",
+    "vbr": "0",
+    "comp": "10",
+    "cbr": False,
+}
+type_settings = {
+    "flac": {"comp": "8"},
+    "ogg": {"vbr": "9"},
+    "opus": {"vbr": "320"},
+    "aac": {"vbr": "500"},
+    "m4a": {"vbr": "5"},
+}
+
+spec_options = ["format", "directory", "bitrate", "vbr", "comp", "cbr"]
+
+
+class OutputSpec(object):
+    """An additional output type the captured PCM is teed into, with its
+    own format string, directory and encoder settings"""
+
+    def __init__(self, name, output_type, options):
+        self.name = name
+        self.output_type = output_type
+        self.options = options
+
+    @classmethod
+    def parse(cls, spec):
+        """parses TYPE[;option=value...], e.g.
+        "mp3;vbr=2;format={artist}/{track_name}.{ext}"
+        raises ValueError if spec is not valid"""
+        tokens = spec.split(";")
+        name = tokens[0].strip().lower()
+        if name not in output_types:
+            raise ValueError("unknown output type '" + name + "', use one "
+                             "of " + ", ".join(sorted(output_types.keys())))
+        output_type = output_types[name]
+
+        options = dict(default_settings)
+        options.update(type_settings.get(output_type, {}))
+        options["output_type"] = output_type
+        for token in tokens[1:]:
+            if token.strip() == "":
+                continue
+            if "=" not in token:
+                raise ValueError("option '" + token + "' is not of the "
+                                 "form option=value")
+            option, value = token.split("=", 1)
+            option = option.strip()
+            if option not in spec_options:
+                raise ValueError("unknown option '" + option + "', use one "
+                                 "of " + ", ".join(spec_options))
+            if option == "cbr":
+                value = value.strip().lower() in ["1", "yes", "true"]
+            elif option in ["format", "directory"]:
+                value = [value]
+            options[option] = value
+        return cls(name, output_type, options)
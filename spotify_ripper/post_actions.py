@@ -12,14 +12,17 @@ import shutil
 
 
 class PostActions(object):
-    tracks_to_remove = []
     fail_log_file = None
-    success_tracks = []
-    failure_tracks = []
+
+    # called with (track, success) for every logged track
+    listener = None
 
     def __init__(self, args, ripper):
         self.args = args
         self.ripper = ripper
+        self.tracks_to_remove = []
+        self.success_tracks = []
+        self.failure_tracks = []
 
         # create a log file for rip failures
         if args.fail_log is not None:
@@ -33,9 +36,13 @@ class PostActions(object):
 
     def log_success(self, track):
         self.success_tracks.append(track)
+        if self.listener is not None:
+            self.listener(track, True)
 
     def log_failure(self, track):
         self.failure_tracks.append(track)
+        if self.listener is not None:
+            self.listener(track, False)
         if self.fail_log_file is not None:
             self.fail_log_file.write(track.link.uri + "\n")
 
@@ -163,7 +170,7 @@ class PostActions(object):
         else:
             return None
 
-    def create_playlist_m3u(self, tracks):
+    def create_playlist_m3u(self, items):
         args = self.args
         ripper = self.ripper
 
@@ -182,17 +189,14 @@ class PostActions(object):
             print(Fore.GREEN + "Gotta fix playlist name. " +
                   playlist_path_fixed + Fore.RESET)
             with codecs.open(playlist_path_fixed, 'w', encoding) as playlist:
-                for idx, track in enumerate(tracks):
-                    track.load()
-                    if track.is_local:
-                        continue
-                    _file = ripper.format_track_path(idx, track)
-                    if path_exists(_file):
+                for item in items:
+                    _file = item.audio_file
+                    if _file is not None and path_exists(_file):
                         playlist.write(os.path.relpath(_file, _base_dir) +
                                        "\n")
 			
 
-    def create_playlist_wpl(self, tracks):
+    def create_playlist_wpl(self, items):
         args = self.args
         ripper = self.ripper
 
@@ -210,12 +214,9 @@ class PostActions(object):
             with codecs.open(playlist_path, 'w', encoding) as playlist:
                 # to get an accurate track count
                 track_paths = []
-                for idx, track in enumerate(tracks):
-                    track.load()
-                    if track.is_local:
-                        continue
-                    _file = ripper.format_track_path(idx, track)
-                    if path_exists(_file):
+                for item in items:
+                    _file = item.audio_file
+                    if _file is not None and path_exists(_file):
                         track_paths.append(_file)
 
                 playlist.write('<?wpl version="1.0"?>\n')
@@ -278,7 +279,10 @@ class PostActions(object):
                   "Removing successfully ripped tracks from playlist " +
                   ripper.current_playlist.name + "..." + Fore.RESET)
 
-            ripper.current_playlist.remove_tracks(self.tracks_to_remove)
+            # tracks may have been ripped out of playlist order
+            ripper.current_playlist.remove_tracks(
+                sorted(set(self.tracks_to_remove)))
+            self.tracks_to_remove = []
 
             while ripper.current_playlist.has_pending_changes:
                 time.sleep(0.1)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import threading
+import spotify
+
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+
+class Prefetcher(threading.Thread):
+
+    """Loads the metadata of upcoming tracks in the background.
+
+    While the current track is being captured, the prefetcher loads the
+    next tracks, their album metadata, cover images and (if requested)
+    Web API genres so that tagging and starting the next rip do not have
+    to wait on libspotify.  Only the cover images of the tracks in the
+    current lookahead window are kept around.
+    """
+
+    name = 'SpotifyPrefetchThread'
+
+    def __init__(self, args, ripper):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.args = args
+        self.ripper = ripper
+        self.depth = max(args.prefetch, 0)
+
+        self._runnable = True
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._covers = {}
+        self._window = set()
+
+    def start(self):
+        """Start prefetching (does nothing if prefetching is disabled)"""
+        if self.depth > 0:
+            threading.Thread.start(self)
+
+    def stop(self):
+        self._runnable = False
+        self._queue.put(None)
+
+    def schedule(self, items):
+        """Prefetch the given upcoming manifest items and forget the
+        cover images of albums that are no longer in the window"""
+        if self.depth == 0:
+            return
+
+        items = items[:self.depth]
+        window = set()
+        for item in items:
+            window.add(item.metadata.album_uri)
+
+        with self._lock:
+            for uri in list(self._covers.keys()):
+                if uri not in window:
+                    del self._covers[uri]
+            self._window = window
+
+        # let libspotify start buffering the very next track
+        if len(items) > 0:
+            try:
+                self.ripper.session.player.prefetch(items[0].track)
+            except spotify.Error:
+                pass
+
+        for item in items:
+            self._queue.put(item)
+
+    def cover(self, metadata):
+        """Returns the loaded cover image for the track's album or None"""
+        uri = metadata.album_uri
+        with self._lock:
+            if uri in self._covers:
+                return self._covers[uri]
+
+        album = self.ripper.session.get_album(uri)
+        album.load()
+        image = album.cover()
+        if image is not None:
+            image.load()
+
+        with self._lock:
+            if uri in self._window:
+                self._covers[uri] = image
+        return image
+
+    def run(self):
+        args = self.args
+
+        while self._runnable:
+            item = self._queue.get()
+            if item is None or not self._runnable:
+                break
+
+            # the ripper will load anything that fails here itself
+            try:
+                track = item.track
+                if not track.is_loaded:
+                    track.load()
+                self.ripper.metadata.album(item.metadata)
+                self.cover(item.metadata)
+                if args.genres is not None:
+                    self.ripper.web.get_genres(args.genres[0], item.metadata,
+                                               verbose=False)
+            except (spotify.Error, Exception):
+                continue
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+import os
+import json
+import errno
+import threading
+import multiprocessing
+
+# 44.1 kHz, 16 bit stereo
+PCM_BYTES_PER_SECOND = 44100 * 2 * 2
+
+
+def wait_process(proc):
+    """waits for proc like Popen.wait() but reaps it with os.wait4 to get
+    its resource usage, returns (ret_code, rusage). rusage is None where
+    wait4 is not available"""
+    if not hasattr(os, "wait4"):
+        return proc.wait(), None
+
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            # already reaped
+            return proc.wait(), None
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, rusage
+
+
+def encoder_run(output_type, wall_time, rusage, bytes_in, bytes_out,
+                write_time=0.0):
+    """the stats of a single encoder run"""
+    run = {
+        "output_type": output_type,
+        "wall_time": wall_time,
+        "write_block_time": write_time,
+        "bytes_in": bytes_in,
+        "bytes_out": bytes_out,
+    }
+    if rusage is not None:
+        run["user_time"] = rusage.ru_utime
+        run["sys_time"] = rusage.ru_stime
+        run["max_rss_kb"] = rusage.ru_maxrss
+    return run
+
+
+def file_size(file_enc):
+    try:
+        return os.path.getsize(file_enc)
+    except (OSError, TypeError):
+        return 0
+
+
+class EncoderProfiler(object):
+    """Collects the resource usage of every encoder run and sums it up
+    per output type at the end of the run, so it is easy to see which
+    encoder is the bottleneck on a host"""
+
+    def __init__(self, args):
+        self.args = args
+        self.runs = []
+        self._lock = threading.Lock()
+
+    def record(self, runs):
+        with self._lock:
+            self.runs.extend(run for run in runs if run is not None)
+
+    def summary(self):
+        formats = {}
+        for run in self.runs:
+            output_type = run["output_type"]
+            if output_type not in formats:
+                formats[output_type] = {
+                    "runs": 0, "audio_time": 0.0, "wall_time": 0.0,
+                    "user_time": 0.0, "sys_time": 0.0, "max_rss_kb": 0,
+                    "write_block_time": 0.0, "bytes_in": 0, "bytes_out": 0}
+            stats = formats[output_type]
+            stats["runs"] += 1
+            stats["audio_time"] += \
+                run["bytes_in"] / float(PCM_BYTES_PER_SECOND)
+            for key in ["wall_time", "user_time", "sys_time",
+                        "write_block_time", "bytes_in", "bytes_out"]:
+                stats[key] += run.get(key, 0)
+            stats["max_rss_kb"] = max(stats["max_rss_kb"],
+                                      run.get("max_rss_kb", 0))
+
+        for stats in formats.values():
+            cpu_time = stats["user_time"] + stats["sys_time"]
+            stats["cpu_time"] = cpu_time
+            stats["speed"] = stats["audio_time"] / stats["wall_time"] \
+                if stats["wall_time"] > 0 else None
+            stats["cpu_per_audio_second"] = \
+                cpu_time / stats["audio_time"] \
+                if stats["audio_time"] > 0 else None
+        return formats
+
+    def stats_path(self):
+        return os.path.join(settings_dir(), "encoder_stats.json")
+
+    def close(self):
+        """print the per-format summary and write it to the stats file"""
+        if len(self.runs) == 0:
+            return
+        formats = self.summary()
+
+        print(Fore.YELLOW + "\nEncoder Summary\n" + ("-" * 79) + Fore.RESET)
+        for output_type in sorted(formats.keys()):
+            stats = formats[output_type]
+            speed = "%.1fx real time" % stats["speed"] \
+                if stats["speed"] is not None else "-"
+            print(output_type + ": " + str(stats["runs"]) + " runs, " +
+                  speed + ", CPU %.1fs user %.1fs sys, max RSS %s, "
+                  "%.1fs blocked writing, %s in, %s out" %
+                  (stats["user_time"], stats["sys_time"],
+                   format_size(stats["max_rss_kb"] * 1024),
+                   stats["write_block_time"],
+                   format_size(stats["bytes_in"]),
+                   format_size(stats["bytes_out"])))
+
+        stats_path = self.stats_path()
+        try:
+            with open(enc_str(stats_path), "w") as stats_file:
+                json.dump({"cpus": multiprocessing.cpu_count(),
+                           "formats": formats, "runs": self.runs},
+                          stats_file, indent=2, sort_keys=True)
+            print("Encoder stats written to " + stats_path)
+        except (IOError, OSError) as e:
+            print(Fore.YELLOW + "Warning: could not write encoder stats " +
+                  stats_path + Fore.RESET)
+            print(str(e))
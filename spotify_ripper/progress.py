@@ -49,41 +49,39 @@ class Progress(object):
         if not self.args.has_log:
             schedule.every(2).seconds.do(self.eta_calc)
 
-    def calc_total(self, track_pairs):
-        if len(track_pairs) <= 1:
-            return
-
-        self.show_total = True
+    def reset_total(self):
+        """forget the totals of the previous chunk of URIs or daemon job"""
+        self.show_total = False
+        self.skipped_tracks = 0
         self.track_idx = 0
         self.total_tracks = 0
+        self.total_position = 0
         self.total_duration = 0
         self.total_size = 0
+        self.total_eta = None
+
+    def calc_total(self, manifest):
+        self.reset_total()
+        if len(manifest) <= 1:
+            return
 
-        # some duplicate work here, maybe cache this info beforehand?
-        for pair in track_pairs:
-            try:
-                track = pair[0]
-                audio_file = pair[1]
-
-                track.load()
-                # check if we should skip track
-                if track.availability != 1 or track.is_local:
-                    self.skipped_tracks += 1
-                    continue
-
-                # check if we should overwrite existing file
-                if not self.args.overwrite and path_exists(audio_file) and \
-                        not is_partial(audio_file, track):
-                    self.skipped_tracks += 1
-                    continue
-
-                self.total_tracks += 1
-                self.total_duration += track.duration
-                file_size = calc_file_size(track)
-                self.total_size += file_size
-            except spotify.Error as e:
+        self.show_total = True
+        for item in manifest:
+            # the track will be loaded again once we get to it
+            if not item.resolved:
+                continue
+
+            # check if we should skip track
+            if not item.available or item.skip or \
+                    item.reuse_file is not None:
+                self.skipped_tracks += 1
                 continue
 
+            self.total_tracks += 1
+            self.total_duration += item.metadata.duration
+            file_size = calc_file_size(item.metadata)
+            self.total_size += file_size
+
     def eta_calc(self):
         # exponential moving average
         def calc_rate(rate, avg_rate, smoothing_factor):
@@ -154,6 +152,11 @@ class Progress(object):
         self.total_position += self.current_track.duration
         self.current_track = None
 
+    def restart_track(self, track):
+        """forget the progress of a track that is ripped again"""
+        self.track_idx -= 1
+        self.total_position -= track.duration
+
     def update_progress(self, num_frames, sample_rate):
         if self.args.has_log:
             return
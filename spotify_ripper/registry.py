@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from spotify_ripper.utils import *
+import os
+import time
+import shutil
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+class RipRegistry(object):
+    """Persistent record of every file we ripped (or found already ripped),
+    keyed by Spotify URI and output type, so a track that already exists
+    somewhere in the library can be linked or copied to a new path instead
+    of being ripped again. The hash of the captured PCM is kept too, so the
+    same audio under a different URI can be found after capturing it"""
+
+    commit_interval = 100
+
+    def __init__(self, args):
+        self.args = args
+        self.mode = args.reuse_existing
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._db = None
+
+        if self.mode != "none":
+            self.open()
+
+    def db_path(self):
+        return os.path.join(settings_dir(), "registry.db")
+
+    def open(self):
+        db_path = self.db_path()
+        try:
+            if not path_exists(os.path.dirname(db_path)):
+                os.makedirs(enc_str(os.path.dirname(db_path)))
+            self._db = sqlite3.connect(enc_str(db_path),
+                                       check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS registry ("
+                "uri TEXT NOT NULL, output_type TEXT NOT NULL, "
+                "path TEXT NOT NULL, size INTEGER NOT NULL, "
+                "duration INTEGER NOT NULL, updated REAL NOT NULL, "
+                "PRIMARY KEY (uri, output_type, path))")
+
+            # registries of older versions have no PCM hashes
+            columns = [row[1] for row in
+                       self._db.execute("PRAGMA table_info(registry)")]
+            if "pcm_hash" not in columns:
+                self._db.execute(
+                    "ALTER TABLE registry ADD COLUMN pcm_hash TEXT")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS registry_pcm_hash ON "
+                "registry (pcm_hash)")
+            self._db.commit()
+        except sqlite3.Error as e:
+            print(Fore.YELLOW + "Warning: could not open rip registry " +
+                  db_path + Fore.RESET)
+            print(str(e))
+            self._db = None
+
+    def close(self):
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                self._db.commit()
+                self._db.close()
+            except sqlite3.Error as e:
+                print(Fore.YELLOW + "Warning: error while saving rip "
+                      "registry" + Fore.RESET)
+                print(str(e))
+            self._db = None
+
+    def commit(self, force=False):
+        self._pending += 1
+        if force or self._pending >= self.commit_interval:
+            self._pending = 0
+            self._db.commit()
+
+    def record(self, uri, audio_file, duration, pcm_hash=None,
+               output_type=None):
+        """remember that audio_file holds a complete rip of uri, an
+        already known PCM hash is kept if pcm_hash is not given"""
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                if output_type is None:
+                    output_type = self.args.output_type
+                size = os.path.getsize(enc_str(audio_file))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO registry (uri, output_type, "
+                    "path, size, duration, updated, pcm_hash) "
+                    "VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, (SELECT "
+                    "pcm_hash FROM registry WHERE uri = ? AND "
+                    "output_type = ? AND path = ?)))",
+                    (uri, output_type, audio_file, size, duration,
+                     time.time(), pcm_hash, uri, output_type, audio_file))
+                self.commit()
+            except (OSError, sqlite3.Error) as e:
+                print(Fore.YELLOW + "Warning: could not record " +
+                      audio_file + " in rip registry" + Fore.RESET)
+                print(str(e))
+
+    def forget(self, uri, audio_file):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM registry WHERE uri = ? AND output_type = ? "
+                "AND path = ?", (uri, self.args.output_type, audio_file))
+            self.commit()
+
+    def find(self, uri, audio_file):
+        """returns the path of an existing rip of uri other than
+        audio_file or None"""
+        with self._lock:
+            if self._db is None:
+                return None
+            try:
+                rows = self._db.execute(
+                    "SELECT uri, path, size FROM registry WHERE uri = ? "
+                    "AND output_type = ? ORDER BY updated DESC",
+                    (uri, self.args.output_type)).fetchall()
+                return self.first_existing(rows, audio_file)
+            except sqlite3.Error as e:
+                print(str(e))
+        return None
+
+    def find_audio(self, pcm_hash, audio_file):
+        """returns the path of an existing rip of exactly the same audio
+        (e.g. the same recording on a compilation) other than audio_file
+        or None"""
+        with self._lock:
+            if self._db is None:
+                return None
+            try:
+                rows = self._db.execute(
+                    "SELECT uri, path, size FROM registry WHERE "
+                    "pcm_hash = ? AND output_type = ? ORDER BY updated DESC",
+                    (pcm_hash, self.args.output_type)).fetchall()
+                return self.first_existing(rows, audio_file)
+            except sqlite3.Error as e:
+                print(str(e))
+        return None
+
+    def first_existing(self, rows, audio_file):
+        """returns the first path of rows other than audio_file whose
+        file is still there, entries whose file is gone or changed size
+        are dropped"""
+        for uri, path, size in rows:
+            if path == audio_file:
+                continue
+            try:
+                if os.path.getsize(enc_str(path)) == size:
+                    return path
+            except OSError:
+                pass
+            self.forget(uri, path)
+        return None
+
+    def reuse(self, existing_file, audio_file, link=True):
+        """hardlink, reflink or copy existing_file to audio_file, returns
+        the method that was used. With link=False the new file never
+        shares its tags with existing_file"""
+        src = enc_str(existing_file)
+        dst = enc_str(audio_file)
+
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+        if self.mode == "link" and link:
+            try:
+                os.link(src, dst)
+                return "hardlink"
+            except (OSError, AttributeError):
+                pass
+
+        if fcntl is not None:
+            try:
+                with open(src, "rb") as src_file:
+                    with open(dst, "wb") as dst_file:
+                        fcntl.ioctl(dst_file.fileno(), FICLONE,
+                                    src_file.fileno())
+                shutil.copystat(src, dst)
+                return "reflink"
+            except (IOError, OSError):
+                pass
+
+        shutil.copy2(src, dst)
+        return "copy"
@@ -2,14 +2,25 @@
 
 from __future__ import unicode_literals
 
-from subprocess import Popen, PIPE
 from colorama import Fore, Style
 from spotify_ripper.utils import *
-from spotify_ripper.tags import set_metadata_tags
+from spotify_ripper.tags import set_metadata_tags, set_album_gain_tags, \
+    clear_tags
 from spotify_ripper.progress import Progress
 from spotify_ripper.post_actions import PostActions
 from spotify_ripper.web import WebAPI
-from spotify_ripper.sync import Sync
+from spotify_ripper.manifest import Manifest
+from spotify_ripper.prefetch import Prefetcher
+from spotify_ripper.metadata import MetadataCache
+from spotify_ripper.registry import RipRegistry
+from spotify_ripper.journal import RipJournal
+from spotify_ripper.buffers import PCMBufferPool
+from spotify_ripper.sinks import open_sink, TeeSink, EncoderLauncher
+from spotify_ripper.spool import Spooler
+from spotify_ripper.finisher import Finisher, FinishJob
+from spotify_ripper.profiling import EncoderProfiler
+from spotify_ripper.analysis import DropoutDetector, LoudnessMeter, Loudness
+from spotify_ripper.stall import StallMonitor
 from spotify_ripper.eventloop import EventLoop
 from datetime import datetime
 import os
@@ -18,18 +29,12 @@ import time
 import threading
 import spotify
 import getpass
+import copy
+import hashlib
 import itertools
-import wave
 import re
 import select
 
-try:
-    # Python 3
-    import queue
-except ImportError:
-    # Python 2
-    import Queue as queue
-
 
 class BitRate(spotify.utils.IntEnum):
     BITRATE_160K = 0
@@ -41,10 +46,8 @@ class Ripper(threading.Thread):
     name = 'SpotifyRipperThread'
 
     audio_file = None
-    pcm_file = None
-    wav_file = None
-    rip_proc = None
-    pipe = None
+    extra_files = []
+    sink = None
     current_playlist = None
     current_album = None
     current_chart = None
@@ -54,26 +57,46 @@ class Ripper(threading.Thread):
     sync = None
     post = None
     web = None
-    dev_null = None
+    manifest = None
+    prefetch = None
+    metadata = None
+    registry = None
+    journal = None
+    spool = None
+    supervisor = None
+    worker = None
+    job_server = None
     stop_time = None
-    track_path_cache = {}
-
-    rip_queue = queue.Queue()
 
-    # threading events
-    logged_in = threading.Event()
-    logged_out = threading.Event()
-    ripper_continue = threading.Event()
-    ripping = threading.Event()
-    end_of_track = threading.Event()
-    finished = threading.Event()
-    abort = threading.Event()
-    skip = threading.Event()
-    play_token_resume = threading.Event()
+    # ratio of the time it takes to rip a track to its duration
+    rip_ratio = 1.0
 
     def __init__(self, args):
         threading.Thread.__init__(self)
 
+        # per-instance state so several rippers can live in one process
+        self.track_path_cache = {}
+        self.pcm_pool = PCMBufferPool()
+        self.encoders = EncoderLauncher(args)
+        self.dropouts = DropoutDetector()
+        self.pcm_hash = hashlib.sha1()
+        self.stall_monitor = StallMonitor(args.stall_timeout,
+                                          args.stall_min_rate)
+        self.loudness_meter = LoudnessMeter()
+        self.loudness = {}
+
+        # threading events
+        self.logged_in = threading.Event()
+        self.logged_out = threading.Event()
+        self.ripper_continue = threading.Event()
+        self.ripping = threading.Event()
+        self.end_of_track = threading.Event()
+        self.finished = threading.Event()
+        self.abort = threading.Event()
+        self.stopped = threading.Event()
+        self.skip = threading.Event()
+        self.play_token_resume = threading.Event()
+
         # initialize progress meter
         self.progress = Progress(args, self)
 
@@ -87,6 +110,14 @@ class Ripper(threading.Thread):
 
         self.post = PostActions(args, self)
         self.web = WebAPI(args, self)
+        self.prefetch = Prefetcher(args, self)
+        self.metadata = MetadataCache(args, self)
+        self.registry = RipRegistry(args)
+        self.journal = RipJournal(args)
+        if args.spool:
+            self.spool = Spooler(args, self)
+        self.finisher = Finisher(args, self)
+        self.profiler = EncoderProfiler(args)
 
         proxy = os.environ.get('http_proxy')
         if proxy is not None:
@@ -186,221 +217,494 @@ class Ripper(threading.Thread):
         if self.abort.is_set():
             return
 
-        # list of spotify URIs
-        uris = args.uri
+        self.manifest = Manifest(args, self)
+        self.prefetch.start()
 
-        def get_tracks_from_uri(uri):
-            self.current_playlist = None
-            self.current_album = None
-            self.current_chart = None
-
-            if isinstance(uri, list):
-                return uri
-            else:
-                if (uri.startswith("spotify:artist:") and
-                        (args.artist_album_type is not None or
-                         args.artist_album_market is not None)):
-                    album_uris = self.web.get_albums_with_filter(uri)
-                    return itertools.chain(
-                        *[self.load_link(album_uri) for
-                          album_uri in album_uris])
-                elif uri.startswith("spotify:charts:"):
-                    charts = self.web.get_charts(uri)
-                    if charts is not None:
-                        self.current_chart = charts
-                        chart_uris = charts["tracks"]
-                        return itertools.chain(
-                            *[self.load_link(chart_uri) for
-                              chart_uri in chart_uris])
-                    else:
-                        return iter([])
-                else:
-                    return self.load_link(uri)
+        if self.worker is not None:
+            # worker processes get their tracks from the supervisor
+            self.worker.rip_work_queue()
+        elif self.job_server is not None:
+            # daemon mode, rip jobs until we are told to stop
+            self.job_server.run_jobs()
+        else:
+            self.rip_uris()
 
-        # calculate total size and time
-        all_tracks = []
-        for uri in uris:
-            tracks = list(get_tracks_from_uri(uri))
+        # logout, we are done
+        if self.supervisor is not None:
+            self.supervisor.stop(abort=self.aborted())
+        self.prefetch.stop()
+        self.encoders.cancel()
+        if self.spool is not None:
+            self.spool.close(abort=self.aborted())
+        self.finisher.stop()
+        self.metadata.close()
+        self.registry.close()
+        self.journal.close()
+        self.profiler.close()
+        self.post.end_failure_log()
+        self.post.print_summary()
+        self.stall_monitor.print_summary()
+        self.logout()
+        self.stop_event_loop()
+        self.finished.set()
 
-            # TODO: remove dependency on current_album, ...
-            for idx, track in enumerate(tracks):
+    def rip_uris(self):
+        for uris in self.uri_chunks():
+            if self.abort.is_set():
+                break
 
-                # ignore local tracks
-                if track.is_local:
-                    continue
+            # resolve every URI once up front
+            self.manifest.resolve(uris)
 
-                audio_file = self.format_track_path(idx, track)
-                all_tracks.append((track, audio_file))
+            self.progress.calc_total(self.manifest)
 
-        self.progress.calc_total(all_tracks)
+            if self.progress.total_size > 0:
+                print(
+                    "Total Download Size: " +
+                    format_size(self.progress.total_size))
 
-        if self.progress.total_size > 0:
-            print(
-                "Total Download Size: " +
-                format_size(self.progress.total_size))
+            if self.supervisor is not None:
+                self.supervisor.rip_manifest(self)
+            else:
+                self.rip_manifest()
+
+            # keep memory flat when streaming a large list of URIs
+            self.manifest.clear()
+            self.track_path_cache.clear()
+
+    def uri_chunks(self):
+        """splits the URIs into chunks of --uri-chunk-size that are
+        resolved and ripped one after another"""
+        chunk_size = self.args.uri_chunk_size
+        if chunk_size <= 0:
+            yield list(self.args.uri)
+            return
 
-        # create track iterator
-        for uri in uris:
+        chunk = []
+        for uri in self.args.uri:
+            chunk.append(uri)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def rip_manifest(self, rip_item=None):
+        """rip every source of the manifest, rip_item is called for each
+        item instead of self.rip_item, e.g. to report on it"""
+        if rip_item is None:
+            rip_item = self.rip_item
+
+        for source in self.manifest.sources:
             if self.abort.is_set():
                 break
 
-            tracks = list(get_tracks_from_uri(uri))
-
-            if args.playlist_sync and self.current_playlist:
-                self.sync = Sync(args, self)
-                self.sync.sync_playlist(self.current_playlist)
+            self.manifest.activate(source)
 
             # ripping loop
-            for idx, track in enumerate(tracks):
-                try:
-                    self.check_stop_time()
-                    self.skip.clear()
-
-                    if self.abort.is_set():
-                        break
-
-                    print('Loading track...')
-                    track.load()
-                    if track.availability != 1 or track.is_local:
-                        print(
-                            Fore.RED + 'Track is not available, '
-                                       'skipping...' + Fore.RESET)
-                        self.post.log_failure(track)
-                        continue
-
-                    self.audio_file = self.format_track_path(idx, track)
-
-                    if not args.overwrite and path_exists(self.audio_file):
-                        if is_partial(self.audio_file, track):
-                            print("Overwriting partial file")
-                        else:
-                            print(
-                                Fore.YELLOW + "Skipping " +
-                                track.link.uri + Fore.RESET)
-                            print(Fore.CYAN + self.audio_file + Fore.RESET)
-                            self.post.queue_remove_from_playlist(idx)
-                            continue
-
-                    self.session.player.load(track)
-                    self.prepare_rip(idx, track)
-                    self.session.player.play()
-
-                    timeout_count = 0
-                    while not self.end_of_track.is_set() or \
-                            not self.rip_queue.empty():
-                        try:
-                            if self.abort.is_set() or self.skip.is_set():
-                                break
-
-                            rip_item = self.rip_queue.get(timeout=1)
-
-                            if self.abort.is_set() or self.skip.is_set():
-                                break
-
-                            self.rip(self.session, rip_item[0],
-                                     rip_item[1], rip_item[2])
-                        except queue.Empty:
-                            timeout_count += 1
-                            if timeout_count > 60:
-                                raise spotify.Error("Timeout while "
-                                                    "ripping track")
-
-                    if self.skip.is_set():
-                        extra_line = "" if self.play_token_resume.is_set() \
-                                        else "\n"
-                        print(extra_line + Fore.YELLOW +
-                            "User skipped track... " + Fore.RESET)
-                        self.session.player.play(False)
-                        self.post.clean_up_partial()
-                        self.post.log_failure(track)
-                        self.end_of_track.clear()
-                        self.progress.end_track(show_end=False)
-                        self.ripping.clear()
-                        continue
-
-                    if self.abort.is_set():
-                        self.session.player.play(False)
-                        self.end_of_track.set()
-                        self.post.clean_up_partial()
-                        self.post.log_failure(track)
-                        break
-
-                    self.end_of_track.clear()
-
-                    self.finish_rip(track)
-
-                    # update id3v2 with metadata and embed front cover image
-                    set_metadata_tags(args, self.audio_file, idx, track, self)
-
-                    # make a note of the index and remove all the
-                    # tracks from the playlist when everything is done
-                    self.post.queue_remove_from_playlist(idx)
-
-                except (spotify.Error, Exception) as e:
-                    if isinstance(e, Exception):
-                        print(Fore.RED + "Spotify error detected" + Fore.RESET)
-                    print(str(e))
-                    print("Skipping to next track...")
-                    self.session.player.play(False)
-                    self.post.clean_up_partial()
-                    self.post.log_failure(track)
-                    continue
+            pending = list(source.rip_order)
+            while len(pending) > 0 and not self.abort.is_set():
+                item = self.next_item(pending)
+                if item is None:
+                    break
+                rip_item(item)
+
+            self.finish_source(source)
+
+    def wait_finished(self):
+        """wait until every captured track is encoded and tagged"""
+        if self.spool is not None:
+            self.spool.wait()
+        self.finisher.wait()
+
+    def finish_source(self, source):
+        """post actions once every track of a source was ripped"""
+        # tracks need to be in place before writing playlist files
+        self.wait_finished()
+
+        # the album gain needs every track of the album
+        if self.args.replaygain and source.album is not None:
+            self.set_album_gain(source)
+        for item in source.items:
+            self.loudness.pop(item.track.link.uri, None)
+
+        # create playlist m3u file if needed
+        self.post.create_playlist_m3u(source.items)
+
+        # create playlist wpl file if needed
+        self.post.create_playlist_wpl(source.items)
+
+        # actually removing the tracks from playlist
+        self.post.remove_tracks_from_playlist()
+
+        # remove libspotify's offline storage cache
+        self.post.remove_offline_cache()
+
+    def rip_item(self, item):
+        """rips a single manifest item, returns True if the track was
+        ripped or did not need to be"""
+        args = self.args
+        idx = item.idx
+        track = item.track
+        try:
+            self.check_stop_time()
+            self.skip.clear()
 
-            # create playlist m3u file if needed
-            self.post.create_playlist_m3u(tracks)
+            if self.abort.is_set():
+                return False
 
-            # create playlist wpl file if needed
-            self.post.create_playlist_wpl(tracks)
+            # tag and move tracks that finished encoding in the meantime
+            if self.spool is not None:
+                self.spool.process()
 
-            # actually removing the tracks from playlist
-            self.post.remove_tracks_from_playlist()
+            print('Loading track...')
+            if not item.resolved:
+                self.manifest.resolve_item(item)
+                self.manifest.check_existing(item)
 
-            # remove libspotify's offline storage cache
-            self.post.remove_offline_cache()
+            if not item.available:
+                print(
+                    Fore.RED + 'Track is not available, '
+                               'skipping...' + Fore.RESET)
+                self.post.log_failure(track)
+                return False
+
+            self.audio_file = item.audio_file
+
+            # the same track may appear more than once
+            if item.skip or (not args.overwrite and
+                             self.audio_file in
+                             self.manifest.ripped_paths):
+                item.skip = True
+                print(
+                    Fore.YELLOW + "Skipping " +
+                    track.link.uri + Fore.RESET)
+                print(Fore.CYAN + self.audio_file + Fore.RESET)
+                self.post.queue_remove_from_playlist(idx)
+                return True
+            elif item.partial:
+                print("Overwriting partial file")
+
+            if item.reuse_file is not None and \
+                    self.reuse_existing(item):
+                self.post.queue_remove_from_playlist(idx)
+                return True
+
+            # metadata may have come from the cache
+            track.load()
+
+            self.journal.mark(track.link.uri, self.audio_file,
+                              self.journal.CAPTURING)
+            rip_start = time.time()
+            self.pcm_pool.clear()
+            self.session.player.load(track)
+            self.prepare_rip(idx, track)
+            self.session.player.play()
+
+            # load what comes next while this track is captured
+            self.prefetch.schedule(
+                self.manifest.upcoming(item, self.prefetch.depth))
+            if self.spool is None:
+                upcoming = self.manifest.upcoming(item, 1)
+                # a track listed twice is written to the same path, that
+                # one is skipped once this capture is done
+                if len(upcoming) > 0 and \
+                        upcoming[0].audio_file != self.audio_file and \
+                        upcoming[0].audio_file not in \
+                        self.manifest.ripped_paths:
+                    self.encoders.spawn(upcoming[0].audio_file)
+
+            stalled = False
+            self.stall_monitor.start()
+            while not self.end_of_track.is_set() or \
+                    self.pcm_pool.depth > 0:
+                if self.abort.is_set() or self.skip.is_set():
+                    break
+
+                # a slow encoder is waited for here and not in a
+                # blocking write, so we keep an eye on skip and abort
+                if not self.sink.writable(timeout=0.5):
+                    self.stall_monitor.throttled()
+                    continue
 
-        # logout, we are done
-        self.post.end_failure_log()
-        self.post.print_summary()
-        self.logout()
-        self.stop_event_loop()
-        self.finished.set()
+                pcm_buffer = self.pcm_pool.get(timeout=0.5)
+                if pcm_buffer is not None:
+                    self.stall_monitor.delivered(pcm_buffer.length)
+                    try:
+                        if self.abort.is_set() or self.skip.is_set():
+                            break
+                        self.rip(self.session, pcm_buffer)
+                    finally:
+                        self.pcm_pool.release(pcm_buffer)
+
+                # checked on every pass, a slow trickle of audio rarely
+                # leaves the pool empty for long
+                if not self.end_of_track.is_set() and \
+                        self.stall_monitor.stalled():
+                    stalled = True
+                    break
+
+            if self.skip.is_set():
+                extra_line = "" if self.play_token_resume.is_set() \
+                                else "\n"
+                print(extra_line + Fore.YELLOW +
+                    "User skipped track... " + Fore.RESET)
+                self.session.player.play(False)
+                self.discard_rip()
+                self.post.clean_up_partial()
+                self.post.log_failure(track)
+                self.end_of_track.clear()
+                self.progress.end_track(show_end=False)
+                self.ripping.clear()
+                return False
 
-    def check_stop_time(self):
+            if self.abort.is_set():
+                self.session.player.play(False)
+                self.end_of_track.set()
+                self.discard_rip()
+                self.post.clean_up_partial()
+                self.post.log_failure(track)
+                return False
+
+            self.end_of_track.clear()
+
+            # load the track again if the stream stalled
+            if stalled:
+                print("\n" + Fore.YELLOW + "Stream stalled (" +
+                      self.stall_monitor.reason + ")" + Fore.RESET)
+                if item.stalls >= args.stall_retries:
+                    raise spotify.Error("Stream stalled while ripping "
+                                        "track")
+                item.stalls += 1
+                return self.restart_rip(item)
+
+            # rip the track again if the stream dropped out
+            if self.check_dropouts(item):
+                return self.restart_rip(item)
+
+            if args.replaygain:
+                self.loudness[track.link.uri] = self.loudness_meter.finish()
+            self.finish_rip(track)
+            item.pcm_hash = self.pcm_hash.hexdigest()
+            self.manifest.ripped_paths.add(self.audio_file)
+            self.update_rip_ratio(time.time() - rip_start, track.duration)
+
+            # encoding, tagging and moving into place happen in the
+            # background, we go on with capturing the next track
+            if self.spool is not None:
+                self.close_sink(self.sink)
+                self.sink = None
+                extra_files = self.extra_files
+                self.extra_files = []
+
+                # the same audio may be in the library under another URI
+                if args.dedup_audio and \
+                        self.reuse_captured(item, extra_files):
+                    self.post.log_success(track)
+                else:
+                    self.spool.submit(item, extra_files)
+                return True
+
+            # draining the encoders and tagging too
+            job = FinishJob(item, self.sink, self.extra_files,
+                            copy.copy(args))
+            self.sink = None
+            self.extra_files = []
+            self.finisher.submit(job)
+            return True
+
+        except (spotify.Error, Exception) as e:
+            if isinstance(e, Exception):
+                print(Fore.RED + "Spotify error detected" + Fore.RESET)
+            print(str(e))
+            print("Skipping to next track...")
+            self.session.player.play(False)
+            self.discard_rip()
+            self.post.clean_up_partial()
+            self.post.log_failure(track)
+            return False
+
+    def reuse_existing(self, item):
+        """link or copy an existing rip of the item's track instead of
+        ripping it again, returns False if we need to rip it after all"""
+        try:
+            method = self.registry.reuse(item.reuse_file, item.audio_file)
+        except (IOError, OSError) as e:
+            print(Fore.YELLOW + "Could not reuse existing file " +
+                  item.reuse_file + ", ripping track instead" + Fore.RESET)
+            print(str(e))
+            rm_file(item.audio_file)
+            return False
+
+        print(Fore.YELLOW + "Reusing existing " + method + " of " +
+              item.metadata.uri + Fore.RESET)
+        print(Fore.CYAN + item.reuse_file + " -> " + item.audio_file +
+              Fore.RESET)
+        self.manifest.ripped_paths.add(item.audio_file)
+        self.registry.record(
+            item.metadata.uri, item.audio_file, item.metadata.duration)
+        self.journal.mark(item.metadata.uri, item.audio_file,
+                          self.journal.DONE)
+        self.post.log_success(item.track)
+        return True
+
+    def restart_rip(self, item):
+        """throw away what was captured of item and rip it again"""
+        self.session.player.play(False)
+        self.discard_rip()
+        self.post.clean_up_partial()
+        self.progress.end_track(show_end=False)
+        self.progress.restart_track(item.track)
+        self.ripping.clear()
+        print(Fore.YELLOW + "Ripping track again..." + Fore.RESET)
+        return self.rip_item(item)
+
+    def reuse_captured(self, item, extra_files, args=None):
+        """copy an existing rip of exactly the same audio instead of
+        keeping the track we just captured, returns False if there is
+        none or it could not be reused. The copy is never a hardlink,
+        it gets the tags (and album gain) of its own release"""
+        if args is None:
+            args = self.args
+        existing = self.registry.find_audio(item.pcm_hash, item.audio_file)
+        if existing is None:
+            return False
+
+        # copy and tag next to the new file first, so it is kept if
+        # that fails
+        temp_file = temp_path(item.audio_file)
+        try:
+            method = self.registry.reuse(existing, temp_file, link=False)
+            clear_tags(args, temp_file)
+            set_metadata_tags(args, temp_file, item.idx, item.track, self)
+            os.rename(enc_str(temp_file), enc_str(item.audio_file))
+        except Exception as e:
+            print(Fore.YELLOW + "Could not reuse existing file " +
+                  existing + Fore.RESET)
+            print(str(e))
+            rm_file(temp_file)
+            return False
+
+        # nothing was encoded yet
+        if self.spool is not None:
+            rm_file(self.spool.spool_file(item.audio_file))
+
+        print(Fore.YELLOW + "Captured audio is identical to an existing "
+              "rip, reusing its " + method + Fore.RESET)
+        print(Fore.CYAN + existing + " -> " + item.audio_file + Fore.RESET)
+        uri = item.metadata.uri
+        self.finish_extra_outputs(item.idx, item.track, extra_files,
+                                  item.pcm_hash, args)
+        self.registry.record(uri, item.audio_file, item.metadata.duration,
+                             item.pcm_hash)
+        self.journal.mark(uri, item.audio_file, self.journal.DONE)
+        self.post.queue_remove_from_playlist(item.idx)
+        return True
+
+    def get_tracks_from_uri(self, uri):
         args = self.args
 
-        def wait_for_resume(resume_time):
-            while datetime.now() < resume_time and not self.abort.is_set():
-                time.sleep(1)
-
-        def stop_time_triggered():
-            print(Fore.YELLOW + "Stop time of " +
-                  self.stop_time.strftime("%H:%M") +
-                  " has been triggered, stopping..." + Fore.RESET)
-
-            if args.resume_after is not None:
-                resume_time = parse_time_str(args.resume_after)
-                print(Fore.YELLOW + "Script will resume at " +
-                      resume_time.strftime("%H:%M") + Fore.RESET)
-                wait_for_resume(resume_time)
-                self.stop_time = None
+        self.current_playlist = None
+        self.current_album = None
+        self.current_chart = None
+
+        if isinstance(uri, list):
+            return uri
+        else:
+            if (uri.startswith("spotify:artist:") and
+                    (args.artist_album_type is not None or
+                     args.artist_album_market is not None)):
+                album_uris = self.web.get_albums_with_filter(uri)
+                return itertools.chain(
+                    *[self.load_link(album_uri) for
+                      album_uri in album_uris])
+            elif uri.startswith("spotify:charts:"):
+                charts = self.web.get_charts(uri)
+                if charts is not None:
+                    self.current_chart = charts
+                    chart_uris = charts["tracks"]
+                    return itertools.chain(
+                        *[self.load_link(chart_uri) for
+                          chart_uri in chart_uris])
+                else:
+                    return iter([])
             else:
-                self.abort.set()
+                return self.load_link(uri)
 
-        if args.stop_after is not None:
-            if self.stop_time is None:
-                self.stop_time = parse_time_str(args.stop_after)
-                print(Fore.YELLOW + "Script will stop after " +
-                      self.stop_time.strftime("%H:%M") + Fore.RESET)
+    def update_rip_ratio(self, elapsed, duration):
+        if duration is None or duration <= 0:
+            return
+        ratio = elapsed / (duration / 1000.0)
+        self.rip_ratio = 0.7 * self.rip_ratio + 0.3 * ratio
+
+    def estimated_rip_time(self, item):
+        """seconds it will probably take to rip item"""
+        if not item.resolved or not item.available or item.skip or \
+                item.reuse_file is not None or \
+                item.metadata.duration is None:
+            return 0
+        return (item.metadata.duration / 1000.0) * self.rip_ratio
+
+    def remaining_time(self):
+        """seconds until --stop-after triggers or None if not set"""
+        if self.args.stop_after is None:
+            return None
+        if self.stop_time is None:
+            self.stop_time = parse_time_str(self.args.stop_after)
+            print(Fore.YELLOW + "Script will stop after " +
+                  self.stop_time.strftime("%H:%M") + Fore.RESET)
+        return (self.stop_time - datetime.now()).total_seconds()
+
+    def next_item(self, items):
+        """pops the next item to rip from items. With --stop-after only
+        tracks that will be ripped before the stop time are admitted and
+        shorter tracks further down are used to fill the remaining time.
+        Returns None if we are aborting"""
+        remaining = self.remaining_time()
+        if remaining is not None:
+            for i, item in enumerate(items):
+                if self.estimated_rip_time(item) <= remaining:
+                    return items.pop(i)
+
+            # none of the tracks fit in the time that is left
+            self.stop_time_triggered()
+            if self.abort.is_set():
+                return None
+        return items.pop(0)
+
+    def wait_for_resume(self, resume_time):
+        print(Fore.YELLOW + "Script will resume at " +
+              resume_time.strftime("%H:%M") + Fore.RESET)
+        while not self.abort.is_set():
+            seconds = (resume_time - datetime.now()).total_seconds()
+            if seconds <= 0:
+                break
+            self.abort.wait(seconds)
+
+    def stop_time_triggered(self):
+        print(Fore.YELLOW + "Stop time of " +
+              self.stop_time.strftime("%H:%M") +
+              " has been triggered, stopping..." + Fore.RESET)
+
+        if self.args.resume_after is not None:
+            self.wait_for_resume(parse_time_str(self.args.resume_after))
+            self.stop_time = None
+        else:
+            # stops ripping like an abort, but what was captured is
+            # still encoded
+            self.stopped.set()
+            self.abort.set()
+
+    def check_stop_time(self):
+        args = self.args
 
-            if self.stop_time < datetime.now():
-                stop_time_triggered()
+        if args.stop_after is not None:
+            if self.remaining_time() < 0:
+                self.stop_time_triggered()
 
         # we also wait if the "play token" was lost
         elif self.play_token_resume.is_set():
-            resume_time = parse_time_str(args.play_token_resume)
-            print(Fore.YELLOW + "Script will resume at " +
-                  resume_time.strftime("%H:%M") + Fore.RESET)
-            wait_for_resume(resume_time)
+            self.wait_for_resume(parse_time_str(args.play_token_resume))
             self.play_token_resume.clear()
 
     def load_link(self, uri):
@@ -525,13 +829,10 @@ class Ripper(threading.Thread):
 
     def on_music_delivery(self, session, audio_format,
                           frame_bytes, num_frames):
-        try:
-            self.rip_queue.put_nowait((audio_format.sample_rate,
-                                       frame_bytes, num_frames))
-        except queue.Full:
-            print(Fore.RED + "rip_queue is full. dropped music data" +
-                  Fore.RESET)
-        return num_frames
+        # returns 0 frames when all buffers are in use so libspotify
+        # delivers the data again later
+        return self.pcm_pool.put(audio_format.sample_rate,
+                                 frame_bytes, num_frames)
 
     def on_connection_state_changed(self, session):
         if session.connection.state is spotify.ConnectionState.LOGGED_IN:
@@ -597,16 +898,17 @@ class Ripper(threading.Thread):
             self.session.logout()
             self.logged_out.wait()
 
-    def format_track_path(self, idx, track):
-        args = self.args
+    def format_track_path(self, idx, track, cache=True, args=None):
+        if args is None:
+            args = self.args
 
         # check if we cached the result already
-        track.load()
-        if track.link.uri in self.track_path_cache:
+        if cache and track.link.uri in self.track_path_cache:
             return self.track_path_cache[track.link.uri]
 
         audio_file = \
-            format_track_string(self, args.format[0].strip(), idx, track)
+            format_track_string(self, args.format[0].strip(), idx, track,
+                                args)
 
         # in case the file name is too long
         def truncate(_str, max_size):
@@ -641,7 +943,7 @@ class Ripper(threading.Thread):
         audio_file = audio_file.replace('*."/\[]:;|=,', '')
 
         # prepend base_dir
-        audio_file = to_ascii(os.path.join(base_dir(), audio_file))
+        audio_file = to_ascii(os.path.join(base_dir(args), audio_file))
 
         if args.normalized_ascii:
             audio_file = to_normalized_ascii(audio_file)
@@ -651,7 +953,8 @@ class Ripper(threading.Thread):
         if not path_exists(audio_path):
             os.makedirs(enc_str(audio_path))
 
-        self.track_path_cache[track.link.uri] = audio_file
+        if cache:
+            self.track_path_cache[track.link.uri] = audio_file
         return audio_file
 
     def replace_filename(self, filename, pattern_list):
@@ -665,6 +968,10 @@ class Ripper(threading.Thread):
 
         # reset progress
         self.progress.prepare_track(track)
+        self.dropouts.start(track.duration)
+        self.loudness_meter.start()
+        self.pcm_hash = hashlib.sha1()
+        self.pcm_pool.reset_stats()
 
         if self.progress.total_tracks > 1:
             print(Fore.GREEN + "[ " + str(self.progress.track_idx) + " / " +
@@ -679,127 +986,150 @@ class Ripper(threading.Thread):
         file_size = calc_file_size(track)
         print("Track Download Size: " + format_size(file_size))
 
-        audio_file_enc = enc_str(self.audio_file)
-
-        if args.output_type == "wav":
-            self.wav_file = wave.open(audio_file_enc, "wb")
-            self.wav_file.setparams((2, 2, 44100, 0, 'NONE', 'not compressed'))
-        elif args.output_type == "pcm":
-            self.pcm_file = open(audio_file_enc, 'wb')
-        elif args.output_type == "flac":
-            self.rip_proc = Popen(
-                ["flac", "-f", ("-" + str(args.comp)), "--silent", "--endian",
-                 "little", "--channels", "2", "--bps", "16", "--sample-rate",
-                 "44100", "--sign", "signed", "-o", audio_file_enc, "-"],
-                stdin=PIPE)
-        elif args.output_type == "alac.m4a":
-            self.rip_proc = Popen(
-                ["avconv", "-nostats", "-loglevel", "0", "-f", "s16le", "-ar",
-                 "44100", "-ac", "2", "-channel_layout", "stereo", "-i", "-",
-                 "-acodec", "alac", audio_file_enc],
-                stdin=PIPE)
-        elif args.output_type == "ogg":
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["oggenc", "--quiet", "--raw", "-b", args.bitrate, "-o",
-                     audio_file_enc, "-"], stdin=PIPE)
-            else:
-                self.rip_proc = Popen(
-                    ["oggenc", "--quiet", "--raw", "-q", args.vbr, "-o",
-                     audio_file_enc, "-"], stdin=PIPE)
-        elif args.output_type == "opus":
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["opusenc", "--quiet", "--comp", args.comp, "--cvbr",
-                     "--bitrate", str(int(args.bitrate) / 2), "--raw",
-                     "--raw-rate", "44100", "-", audio_file_enc], stdin=PIPE)
-            else:
-                self.rip_proc = Popen(
-                    ["opusenc", "--quiet", "--comp", args.comp, "--vbr",
-                     "--bitrate", args.vbr, "--raw", "--raw-rate", "44100",
-                     "-", audio_file_enc], stdin=PIPE)
-        elif args.output_type == "aac":
-            if self.dev_null is None:
-                self.dev_null = open(os.devnull, 'wb')
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["faac", "-P", "-X", "-b", args.bitrate, "-o",
-                     audio_file_enc, "-"], stdin=PIPE,
-                    stdout=self.dev_null, stderr=self.dev_null)
-            else:
-                self.rip_proc = Popen(
-                    ["faac", "-P", "-X", "-q", args.vbr, "-o",
-                     audio_file_enc, "-"], stdin=PIPE,
-                    stdout=self.dev_null, stderr=self.dev_null)
-        elif args.output_type == "m4a":
-            if args.cbr:
-                self.rip_proc = Popen(
-                    ["fdkaac", "-S", "-R", "-b",
-                     args.bitrate, "-o", audio_file_enc, "-"], stdin=PIPE)
-            else:
-                self.rip_proc = Popen(
-                    ["fdkaac", "-S", "-R", "-m", args.vbr,
-                     "-o", audio_file_enc, "-"], stdin=PIPE)
-        elif args.output_type == "mp3":
-            lame_args = ["lame", "--silent"]
-
-            if args.stereo_mode is not None:
-                lame_args.extend(["-m", args.stereo_mode])
-
-            if args.cbr:
-                lame_args.extend(["-cbr", "-b", args.bitrate])
-            else:
-                lame_args.extend(["-V", args.vbr])
-
-            lame_args.extend(["-h", "-r", "-", audio_file_enc])
-            self.rip_proc = Popen(lame_args, stdin=PIPE)
-
-        if self.rip_proc is not None:
-            self.pipe = self.rip_proc.stdin
+        # where the PCM data goes, chosen once per track
+        if self.spool is not None:
+            self.sink = self.spool.open_sink(self.audio_file, track.duration)
+        else:
+            # usually started while the previous track was captured
+            self.sink = self.encoders.take(self.audio_file)
+            if self.sink is None:
+                self.sink = open_sink(args, args.output_type,
+                                      enc_str(self.audio_file))
+
+        # tee the PCM into every --extra-output
+        self.extra_files = []
+        if len(args.extra_outputs) > 0:
+            sinks = [self.sink]
+            for output in args.extra_outputs:
+                _args = output_args(args, output.options)
+                audio_file = self.format_track_path(idx, track, cache=False,
+                                                    args=_args)
+                sinks.append(open_sink(_args, output.output_type,
+                                       enc_str(audio_file)))
+                self.extra_files.append((output, audio_file))
+                print(Fore.CYAN + audio_file + Fore.RESET)
+            self.sink = TeeSink(sinks)
 
         self.ripping.set()
 
     def finish_rip(self, track):
         self.progress.end_track()
-        if self.pipe is not None:
-            print(Fore.GREEN + 'Rip complete' + Fore.RESET)
-            self.pipe.flush()
-            self.pipe.close()
-
-            # wait for process to end before continuing
-            ret_code = self.rip_proc.wait()
-            if ret_code != 0:
-                print(
-                    Fore.YELLOW + "Warning: encoder returned non-zero "
-                                  "error code " + str(ret_code) + Fore.RESET)
-            self.rip_proc = None
-            self.pipe = None
+        print(Fore.GREEN + 'Rip complete' + Fore.RESET)
 
-        if self.wav_file is not None:
-            self.wav_file.close()
-            self.wav_file = None
-
-        if self.pcm_file is not None:
-            self.pcm_file.flush()
-            os.fsync(self.pcm_file.fileno())
-            self.pcm_file.close()
-            self.pcm_file = None
+        pool = self.pcm_pool
+        if pool.full_count > 0:
+            print(Fore.YELLOW + "Encoder fell behind, music delivery was "
+                  "throttled " + str(pool.full_count) + " times (buffer "
+                  "high-water mark " + str(pool.high_water) + "/" +
+                  str(pool.capacity) + ")" + Fore.RESET)
 
         self.ripping.clear()
-        self.post.log_success(track)
 
-    def rip(self, session, sample_rate, frame_bytes, num_frames):
-        if self.ripping.is_set():
-            self.progress.update_progress(num_frames, sample_rate)
-            if self.pipe is not None:
-                self.pipe.write(frame_bytes)
+    def close_sink(self, sink):
+        # waits for the encoder to end before continuing
+        ret_code = sink.close()
+        self.profiler.record(sink.encoder_runs())
+        if ret_code != 0:
+            print(
+                Fore.YELLOW + "Warning: encoder returned non-zero "
+                              "error code " + str(ret_code) + Fore.RESET)
 
-            if self.wav_file is not None:
-                self.wav_file.writeframes(frame_bytes)
+    def rip(self, session, pcm_buffer):
+        if self.ripping.is_set():
+            self.progress.update_progress(pcm_buffer.num_frames,
+                                          pcm_buffer.sample_rate)
+            data = pcm_buffer.data()
+            self.sink.write(data)
+            self.pcm_hash.update(data)
+            if self.args.dropout_check != "off":
+                self.dropouts.feed(data)
+            if self.args.replaygain:
+                self.loudness_meter.feed(data)
+
+    def check_dropouts(self, item):
+        """returns True if the track has to be ripped again"""
+        args = self.args
+        if args.dropout_check == "off":
+            return False
+
+        problems = self.dropouts.finish()
+        if len(problems) == 0:
+            return False
+
+        print(Fore.YELLOW + "Warning: possible dropout in " +
+              item.metadata.uri + ": " + ", ".join(problems) + Fore.RESET)
+        if args.dropout_check == "rerip" and \
+                item.attempts < args.dropout_retries:
+            item.attempts += 1
+            return True
+        return False
+
+    def discard_rip(self):
+        """stop writing the current track after a skip, abort or error"""
+        if self.sink is not None:
+            try:
+                self.sink.abort()
+            except (IOError, OSError) as e:
+                print(str(e))
+            self.sink = None
+
+        for output, audio_file in self.extra_files:
+            rm_file(audio_file)
+        self.extra_files = []
+
+    def finish_extra_outputs(self, idx, track, extra_files, pcm_hash=None,
+                             args=None):
+        """tag and register the files of every --extra-output"""
+        if args is None:
+            args = self.args
+        for output, audio_file in extra_files:
+            _args = output_args(args, output.options)
+            set_metadata_tags(_args, audio_file, idx, track, self)
+            self.registry.record(track.link.uri, audio_file, track.duration,
+                                 pcm_hash, output.output_type)
+
+    def set_album_gain(self, source):
+        """adds the album gain to every track of an album, if all of them
+        were measured in this run"""
+        args = self.args
+        loudnesses = [self.loudness.get(item.track.link.uri)
+                      for item in source.items]
+        measured = [loudness for loudness in loudnesses
+                    if loudness is not None]
+        if len(measured) == 0:
+            return
+        if len(measured) < len(loudnesses):
+            print(Fore.YELLOW + "Not every track of the album was ripped, "
+                  "skipping album gain" + Fore.RESET)
+            return
 
-            if self.pcm_file is not None:
-                self.pcm_file.write(frame_bytes)
+        album = Loudness.combine(loudnesses)
+        if album.gain is None:
+            return
+        print(Fore.YELLOW + "Setting album gain: %.2f dB" % album.gain +
+              Fore.RESET)
+
+        def set_tags(audio_file, args=args):
+            try:
+                set_album_gain_tags(args, audio_file, album)
+            except Exception as e:
+                print(Fore.YELLOW + "Could not set album gain of " +
+                      audio_file + ": " + str(e) + Fore.RESET)
+
+        for item in source.items:
+            set_tags(item.audio_file)
+            for output in args.extra_outputs:
+                _args = output_args(args, output.options)
+                set_tags(self.format_track_path(item.idx, item.track,
+                                                cache=False, args=_args),
+                         _args)
 
     def abort_rip(self):
         self.ripping.clear()
+        self.stopped.clear()
         self.abort.set()
+
+    def aborted(self):
+        """True if ripping was aborted, rather than stopped at the stop
+        time"""
+        return self.abort.is_set() and not self.stopped.is_set()
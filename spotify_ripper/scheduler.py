@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+
+def original_order(items):
+    return list(items)
+
+
+def album_order(items):
+    """group the tracks of each album together (in the order the albums
+    first appear) and rip them by disc and track number, so album
+    metadata, cover images and genres are fetched once and files of one
+    album are written one after another"""
+    groups = []
+    albums = {}
+    for item in items:
+        key = item.metadata.album_uri if item.metadata is not None \
+            else item.position
+        group = albums.get(key)
+        if group is None:
+            group = albums[key] = []
+            groups.append(group)
+        group.append(item)
+
+    def track_key(item):
+        if item.metadata is None:
+            return (0, 0)
+        return (item.metadata.disc or 0, item.metadata.index or 0)
+
+    ordered = []
+    for group in groups:
+        ordered.extend(sorted(group, key=track_key))
+    return ordered
+
+
+def shortest_order(items):
+    """shortest tracks first to get as many tracks ripped as possible,
+    tracks we could not resolve yet go last"""
+    def duration_key(item):
+        if item.metadata is None or item.metadata.duration is None:
+            return (1, 0)
+        return (0, item.metadata.duration)
+
+    return sorted(items, key=duration_key)
+
+
+# rip order strategies, see --rip-order
+strategies = {
+    "original": original_order,
+    "album": album_order,
+    "shortest": shortest_order,
+}
+
+
+def schedule(strategy, items):
+    """returns the items of a manifest source in the order they should be
+    ripped. The items keep their playlist index (idx) so {idx} and
+    --remove-from-playlist are not affected by the order"""
+    return strategies.get(strategy, original_order)(items)
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from subprocess import Popen, PIPE
+from spotify_ripper.utils import *
+from spotify_ripper.encoders import encoder_command
+from spotify_ripper.profiling import wait_process, encoder_run, file_size
+import os
+import time
+import wave
+import threading
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# from linux/fcntl.h
+F_SETPIPE_SZ = 1031
+
+
+class Sink(object):
+    """Where the PCM data of a track is written to.
+
+    Writes are coalesced into preallocated buffers so the few KB that
+    libspotify delivers at a time end up as large writes. A threaded sink
+    hands full buffers to its own writer thread, so a slow encoder never
+    blocks the ripper thread; writable() tells the ripper when all
+    buffers are in flight.
+    """
+
+    coalesce_size = 256 * 1024
+    buffer_count = 4
+
+    def __init__(self, threaded=False):
+        self.threaded = threaded
+        self.error = None
+        self._aborted = False
+        self._cond = threading.Condition(threading.Lock())
+        self._free = [bytearray(self.coalesce_size)
+                      for i in range(self.buffer_count if threaded else 1)]
+        self._pending = deque()
+        self._buffer = self._free.pop()
+        self._length = 0
+        self._thread = None
+
+        # time spent in write_raw() and bytes written
+        self.write_time = 0.0
+        self.bytes_in = 0
+
+        if threaded:
+            self._thread = threading.Thread(target=self.write_loop,
+                                            name="SpotifySinkWriter")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def writable(self, timeout=None):
+        """returns True if write() will not have to wait for the writer
+        thread, waits up to timeout seconds for a buffer to be free"""
+        if not self.threaded:
+            return True
+        with self._cond:
+            if len(self._free) == 0 and self.error is None:
+                self._cond.wait(timeout)
+            return len(self._free) > 0 or self.error is not None
+
+    def write(self, data):
+        """data can be anything supporting the buffer protocol, it is
+        copied before write() returns"""
+        if self.error is not None:
+            raise self.error
+
+        data = memoryview(data)
+        offset = 0
+        length = len(data)
+        while offset < length:
+            size = min(length - offset, self.coalesce_size - self._length)
+            memoryview(self._buffer)[self._length:self._length + size] = \
+                data[offset:offset + size]
+            self._length += size
+            offset += size
+            if self._length == self.coalesce_size:
+                self.flush()
+
+    def flush(self):
+        if self._length == 0:
+            return
+        if not self.threaded:
+            self.write_out(memoryview(self._buffer)[:self._length])
+            self._length = 0
+            return
+
+        with self._cond:
+            self._pending.append((self._buffer, self._length))
+            self._cond.notify_all()
+            while len(self._free) == 0 and self.error is None:
+                self._cond.wait()
+            if self.error is not None:
+                raise self.error
+            self._buffer = self._free.pop()
+            self._length = 0
+
+    def write_loop(self):
+        while True:
+            with self._cond:
+                while len(self._pending) == 0:
+                    self._cond.wait()
+                item = self._pending.popleft()
+            if item is None:
+                break
+
+            buf, length = item
+            try:
+                if not self._aborted and self.error is None:
+                    self.write_out(memoryview(buf)[:length])
+            except (IOError, OSError, ValueError) as e:
+                self.error = e
+            with self._cond:
+                self._free.append(buf)
+                self._cond.notify_all()
+
+    def stop_thread(self):
+        if self._thread is not None:
+            with self._cond:
+                self._pending.append(None)
+                self._cond.notify_all()
+            self._thread.join()
+            self._thread = None
+
+    def write_out(self, data):
+        start = time.time()
+        self.write_raw(data)
+        self.write_time += time.time() - start
+        self.bytes_in += len(data)
+
+    def write_raw(self, data):
+        raise NotImplementedError
+
+    def encoder_runs(self):
+        """stats of the encoder processes behind this sink"""
+        return []
+
+    def close(self):
+        """flush and close the sink, returns an error code or 0"""
+        try:
+            self.flush()
+        finally:
+            self.stop_thread()
+        if self.error is not None:
+            raise self.error
+        return 0
+
+    def abort(self):
+        """stop writing without flushing what is left, call
+        stop_thread() once nothing can block the writer thread anymore"""
+        self._aborted = True
+        self._length = 0
+
+
+class EncoderSink(Sink):
+    """Pipes PCM into an encoder process from a writer thread. If the
+    encoder writes to temp_file_enc, that file is moved to audio_file_enc
+    once the encoder is done"""
+
+    pipe_size = 1024 * 1024
+
+    def __init__(self, command, quiet=False, output_type=None,
+                 audio_file_enc=None, temp_file_enc=None):
+        Sink.__init__(self, threaded=True)
+        self.output_type = output_type
+        self.audio_file_enc = audio_file_enc
+        self.temp_file_enc = temp_file_enc
+        self.run = None
+        self.started = time.time()
+        self.dev_null = open(os.devnull, 'wb') if quiet else None
+        self.proc = Popen(command, stdin=PIPE, stdout=self.dev_null,
+                          stderr=self.dev_null)
+        self.pipe = self.proc.stdin
+        self.grow_pipe()
+
+    def grow_pipe(self):
+        """a larger pipe buffer lets the encoder fall behind for a while
+        before the writer thread blocks (Linux only)"""
+        if fcntl is None:
+            return
+        try:
+            fcntl.fcntl(self.pipe.fileno(), F_SETPIPE_SZ, self.pipe_size)
+        except (IOError, OSError):
+            pass
+
+    def write_raw(self, data):
+        self.pipe.write(data)
+
+    def close(self):
+        try:
+            Sink.close(self)
+            self.pipe.flush()
+            self.pipe.close()
+        except (IOError, OSError, ValueError):
+            # the encoder died, its return code tells us more
+            self.abort_pipe()
+
+        # wait for process to end before continuing
+        ret_code, rusage = wait_process(self.proc)
+        wall_time = time.time() - self.started
+        self.close_dev_null()
+        if self.temp_file_enc is not None and \
+                os.path.exists(self.temp_file_enc):
+            os.rename(self.temp_file_enc, self.audio_file_enc)
+        self.run = encoder_run(self.output_type, wall_time, rusage,
+                               self.bytes_in,
+                               file_size(self.audio_file_enc),
+                               self.write_time)
+        return ret_code
+
+    def write_out(self, data):
+        # a pre-spawned encoder only starts working with the first data
+        if self.bytes_in == 0:
+            self.started = time.time()
+        Sink.write_out(self, data)
+
+    def encoder_runs(self):
+        return [self.run] if self.run is not None else []
+
+    def abort(self):
+        Sink.abort(self)
+
+        # a writer blocked on the pipe gets an error once the encoder
+        # is gone
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.stop_thread()
+        self.abort_pipe()
+        self.close_dev_null()
+        if self.temp_file_enc is not None and \
+                os.path.exists(self.temp_file_enc):
+            os.remove(self.temp_file_enc)
+
+    def abort_pipe(self):
+        try:
+            self.pipe.close()
+        except (IOError, OSError, ValueError):
+            pass
+
+    def close_dev_null(self):
+        if self.dev_null is not None:
+            self.dev_null.close()
+            self.dev_null = None
+
+
+class WaveSink(Sink):
+
+    def __init__(self, audio_file_enc):
+        Sink.__init__(self)
+        # wave.open() only takes str file names on Python 3
+        self.file = open(audio_file_enc, 'wb')
+        self.wav_file = wave.open(self.file, "wb")
+        self.wav_file.setparams((2, 2, 44100, 0, 'NONE', 'not compressed'))
+
+    def write_raw(self, data):
+        # the header is patched once when the file is closed
+        self.wav_file.writeframesraw(data)
+
+    def close(self):
+        Sink.close(self)
+        self.wav_file.close()
+        self.file.close()
+        return 0
+
+    def abort(self):
+        Sink.abort(self)
+        self.wav_file.close()
+        self.file.close()
+
+
+class PCMSink(Sink):
+
+    def __init__(self, audio_file_enc):
+        Sink.__init__(self)
+        self.pcm_file = open(audio_file_enc, 'wb')
+
+    def write_raw(self, data):
+        self.pcm_file.write(data)
+
+    def close(self):
+        Sink.close(self)
+        self.pcm_file.flush()
+        os.fsync(self.pcm_file.fileno())
+        self.pcm_file.close()
+        return 0
+
+    def abort(self):
+        Sink.abort(self)
+        self.pcm_file.close()
+
+
+class TeeSink(object):
+    """Writes the same PCM to several sinks"""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def writable(self, timeout=None):
+        return all(sink.writable(timeout) for sink in self.sinks)
+
+    def write(self, data):
+        for sink in self.sinks:
+            sink.write(data)
+
+    def close(self):
+        """closes every sink, returns the first non-zero error code"""
+        ret_code = 0
+        error = None
+        for sink in self.sinks:
+            try:
+                _ret_code = sink.close()
+            except (IOError, OSError) as e:
+                error = e
+                continue
+            if ret_code == 0:
+                ret_code = _ret_code
+        if error is not None:
+            raise error
+        return ret_code
+
+    def abort(self):
+        for sink in self.sinks:
+            sink.abort()
+
+    def encoder_runs(self):
+        return [run for sink in self.sinks for run in sink.encoder_runs()]
+
+
+class EncoderLauncher(object):
+    """Starts the encoder of the next track while the current one is
+    still captured, so switching tracks does not wait for a process to
+    start. The encoder writes to a hidden file of its own next to the
+    track"""
+
+    def __init__(self, args):
+        self.args = args
+        self.sink = None
+        self.audio_file = None
+
+    def spawn(self, audio_file):
+        """start the encoder of the track saved as audio_file"""
+        if audio_file == self.audio_file:
+            return
+        self.cancel()
+        # written without an encoder
+        if self.args.output_type in ["wav", "pcm"]:
+            return
+
+        temp_file_enc = enc_str(encoder_temp_path(audio_file))
+        command, quiet = encoder_command(self.args, self.args.output_type,
+                                         temp_file_enc)
+        self.sink = EncoderSink(command, quiet, self.args.output_type,
+                                enc_str(audio_file), temp_file_enc)
+        self.audio_file = audio_file
+
+    def take(self, audio_file):
+        """returns the encoder sink for audio_file, started now if it was
+        not started ahead of time, or None if the output type is written
+        without an encoder"""
+        self.spawn(audio_file)
+        sink = self.sink
+        self.sink = None
+        self.audio_file = None
+        return sink
+
+    def cancel(self):
+        """stop the encoder that was started for a track we do not rip
+        next after all"""
+        if self.sink is not None:
+            self.sink.abort()
+            self.sink = None
+            self.audio_file = None
+
+
+def open_sink(args, output_type, audio_file_enc):
+    """returns the sink for a track ripped to output_type"""
+    if output_type == "wav":
+        return WaveSink(audio_file_enc)
+    elif output_type == "pcm":
+        return PCMSink(audio_file_enc)
+
+    command, quiet = encoder_command(args, output_type, audio_file_enc)
+    return EncoderSink(command, quiet, output_type, audio_file_enc)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from subprocess import Popen
+from colorama import Fore
+from spotify_ripper.utils import *
+from spotify_ripper.encoders import encoder_command
+from spotify_ripper.sinks import Sink
+from spotify_ripper.finisher import FinishJob
+from spotify_ripper.profiling import wait_process, encoder_run, file_size
+from spotify_ripper.governor import load_allows
+from collections import deque
+import os
+import sys
+import copy
+import time
+import mmap
+import wave
+import shutil
+import signal
+import hashlib
+import multiprocessing
+
+try:
+    # Python 3
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+
+class SpoolSink(Sink):
+    """Writes the raw PCM of a track to a memory-mapped spool file that
+    is sized up front from the track's duration"""
+
+    def __init__(self, spool_file_enc, expected_size):
+        Sink.__init__(self)
+        self.spool_file_enc = spool_file_enc
+        self.file = open(spool_file_enc, 'w+b')
+        self.size = max(expected_size, mmap.PAGESIZE)
+        self.length = 0
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+    def write(self, data):
+        # mmap slice assignment only takes str on Python 2
+        if sys.version_info < (3, 0) and isinstance(data, memoryview):
+            data = data.tobytes()
+        length = len(data)
+        if self.length + length > self.size:
+            self.map.close()
+            self.size = max(self.size * 2, self.length + length)
+            self.file.truncate(self.size)
+            self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.map[self.length:self.length + length] = data
+        self.length += length
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(self.length)
+        self.file.close()
+        return 0
+
+    def abort(self):
+        self.map.close()
+        self.file.close()
+        os.remove(self.spool_file_enc)
+
+
+def init_encode_worker():
+    # the ripper decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def encode_spool(output_type, command, quiet, spool_file_enc, temp_file_enc):
+    """runs in a pool process, encodes a spool file to temp_file_enc and
+    returns the encoder's return code and the stats of the encoder run"""
+    run = None
+    try:
+        if command is not None:
+            start = time.time()
+            with open(spool_file_enc, 'rb') as spool_file:
+                with open(os.devnull, 'wb') as dev_null:
+                    proc = Popen(command, stdin=spool_file,
+                                 stdout=dev_null if quiet else None,
+                                 stderr=dev_null if quiet else None)
+                    ret_code, rusage = wait_process(proc)
+            run = encoder_run(output_type, time.time() - start, rusage,
+                              file_size(spool_file_enc),
+                              file_size(temp_file_enc))
+        elif output_type == "wav":
+            with open(temp_file_enc, 'wb') as temp_file:
+                wav_file = wave.open(temp_file, "wb")
+                wav_file.setparams(
+                    (2, 2, 44100, 0, 'NONE', 'not compressed'))
+                with open(spool_file_enc, 'rb') as spool_file:
+                    while True:
+                        data = spool_file.read(1024 * 1024)
+                        if not data:
+                            break
+                        wav_file.writeframesraw(data)
+                wav_file.close()
+            ret_code = 0
+        else:
+            shutil.copyfile(spool_file_enc, temp_file_enc)
+            ret_code = 0
+    except (IOError, OSError) as e:
+        print(str(e))
+        ret_code = -1
+
+    try:
+        os.remove(spool_file_enc)
+    except OSError:
+        pass
+    return ret_code, run
+
+
+class SpoolJob(object):
+
+    def __init__(self, item, extra_files, args, spool_file, temp_file,
+                 task):
+        self.item = item
+        self.extra_files = extra_files
+        self.args = args
+        self.spool_file = spool_file
+        self.temp_file = temp_file
+        self.task = task
+        self.ret_code = None
+        self.run = None
+
+
+class EncodedSpool(object):
+    """Stands in for the sink of a spooled track once its encode ended,
+    so the finisher can treat it like any other track"""
+
+    def __init__(self, job):
+        self.job = job
+
+    def close(self):
+        """moves the encoded file into place, raises IOError if the
+        encode failed"""
+        job = self.job
+        temp_file_enc = enc_str(job.temp_file)
+        if job.ret_code != 0 or not os.path.exists(temp_file_enc):
+            rm_file(job.temp_file)
+            raise IOError("encoding failed (" + str(job.ret_code) + ")")
+        os.rename(temp_file_enc, enc_str(job.item.audio_file))
+        return 0
+
+    def abort(self):
+        rm_file(self.job.temp_file)
+
+    def encoder_runs(self):
+        return [self.job.run]
+
+
+class Spooler(object):
+    """Captures tracks to raw PCM spool files and encodes them in a pool
+    of processes (one per CPU by default), so capturing the next track
+    never waits on the encoder. With --encoder-max-load, encodes beyond
+    the first only start while the load average leaves room for them.
+    Finished encodes are handed to the finisher to be moved in place and
+    tagged"""
+
+    def __init__(self, args, ripper):
+        self.args = args
+        self.ripper = ripper
+        self.spool_dir = os.path.join(settings_dir(), "spool")
+        self.jobs = args.encode_jobs if args.encode_jobs > 0 \
+            else multiprocessing.cpu_count()
+        self.pending = {}
+        self.backlog = deque()
+        self.running = 0
+        self.finished = queue.Queue()
+
+        # left over from a run that died
+        if path_exists(self.spool_dir):
+            shutil.rmtree(enc_str(self.spool_dir))
+        os.makedirs(enc_str(self.spool_dir))
+
+        # the pool needs to be forked before the libspotify session
+        # is created
+        self.pool = multiprocessing.Pool(processes=self.jobs,
+                                         initializer=init_encode_worker)
+
+    def spool_file(self, audio_file):
+        name = hashlib.md5(enc_str(audio_file)).hexdigest() + ".pcm"
+        return os.path.join(self.spool_dir, name)
+
+    def open_sink(self, audio_file, duration):
+        # 44.1 kHz, 16 bit stereo plus a few seconds to spare
+        expected_size = int((duration + 5000) * 44100 * 4 / 1000)
+        return SpoolSink(enc_str(self.spool_file(audio_file)), expected_size)
+
+    def submit(self, item, extra_files):
+        """encode the spool file of item that was just captured"""
+        args = copy.copy(self.args)
+        spool_file = self.spool_file(item.audio_file)
+        temp_file = encoder_temp_path(item.audio_file)
+        temp_file_enc = enc_str(temp_file)
+        command, quiet = encoder_command(args, args.output_type,
+                                         temp_file_enc)
+        job = SpoolJob(item, extra_files, args, spool_file, temp_file,
+                       (args.output_type, command, quiet,
+                        enc_str(spool_file), temp_file_enc))
+        self.pending[spool_file] = job
+        self.backlog.append(job)
+        self.dispatch()
+        print(Fore.YELLOW + "Spooled for encoding (" +
+              str(len(self.pending)) + " pending)" + Fore.RESET)
+
+    def dispatch(self):
+        """start encoding spooled tracks as far as the number of encode
+        jobs and the load allow"""
+        while len(self.backlog) > 0 and self.running < self.jobs and \
+                load_allows(self.args, self.running):
+            job = self.backlog.popleft()
+            self.running += 1
+
+            def encoded(result, job=job):
+                job.ret_code, job.run = result
+                self.finished.put(job)
+
+            self.pool.apply_async(encode_spool, job.task, callback=encoded)
+
+    def process(self, block=False):
+        """finish whatever finished encoding, waits for all pending
+        encodes if block is set (unless the rip is aborted)"""
+        while len(self.pending) > 0:
+            try:
+                job = self.finished.get(block=block, timeout=1)
+            except queue.Empty:
+                self.dispatch()
+                if not block or self.ripper.aborted():
+                    return
+                continue
+            del self.pending[job.spool_file]
+            self.running -= 1
+            self.dispatch()
+            self.ripper.finisher.submit(
+                FinishJob(job.item, EncodedSpool(job), job.extra_files,
+                          job.args))
+
+    def wait(self):
+        """finish every pending track, e.g. before the playlist files
+        of a source are written"""
+        if len(self.pending) > 0:
+            print(Fore.YELLOW + "Waiting for " + str(len(self.pending)) +
+                  " tracks to finish encoding..." + Fore.RESET)
+        self.process(block=True)
+
+    def close(self, abort=False):
+        if abort:
+            self.pool.terminate()
+            if len(self.pending) > 0:
+                print(Fore.YELLOW + "Aborted, " + str(len(self.pending)) +
+                      " captured tracks were not encoded" + Fore.RESET)
+            for job in self.pending.values():
+                rm_file(job.temp_file)
+        else:
+            self.wait()
+            self.pool.close()
+        self.pool.join()
+        shutil.rmtree(enc_str(self.spool_dir), ignore_errors=True)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from colorama import Fore
+from collections import deque
+import time
+
+# 44.1 kHz, 16 bit stereo
+REAL_TIME_RATE = 44100 * 2 * 2
+
+
+class StallMonitor(object):
+    """Watches how fast libspotify delivers the PCM of a track and decides
+    when the stream is stalled: no audio at all for `timeout` seconds, or
+    less than `min_rate` times real time over a window of twice that.
+
+    Time the ripper spends waiting on a slow encoder holds back delivery
+    on purpose, so the rate window starts over whenever the ripper was
+    throttled.
+    """
+
+    # no audio yet this long after the track was loaded is a stall too
+    startup_grace = 10.0
+
+    def __init__(self, timeout=5.0, min_rate=0.1):
+        self.timeout = timeout
+        self.min_rate = min_rate
+
+        # how long it took to notice each stall (seconds)
+        self.detect_times = []
+        self.start()
+
+    def start(self):
+        now = time.time()
+        self.started = now
+        self.last_delivery = None
+        self.reason = None
+
+        # (time, bytes) of the deliveries in the rate window
+        self.window_start = now
+        self.window = deque()
+        self.window_bytes = 0
+
+    def delivered(self, num_bytes):
+        now = time.time()
+        self.last_delivery = now
+        self.window.append((now, num_bytes))
+        self.window_bytes += num_bytes
+
+    def throttled(self):
+        now = time.time()
+        self.last_delivery = now
+        self.window_start = now
+        self.window.clear()
+        self.window_bytes = 0
+
+    def stalled(self):
+        """returns True if the stream stalled, call it on every pass of
+        the capture loop whether audio arrived or not"""
+        now = time.time()
+        if self.last_delivery is None:
+            idle = now - self.started
+            if idle >= self.timeout + self.startup_grace:
+                return self.detected(idle, "no audio %.1fs after the "
+                                     "track was loaded" % idle)
+            return False
+
+        idle = now - self.last_delivery
+        if idle >= self.timeout:
+            return self.detected(idle, "no audio for %.1fs" % idle)
+
+        # only the last two timeouts count towards the rate
+        window = self.timeout * 2
+        while len(self.window) > 0 and self.window[0][0] < now - window:
+            self.window_bytes -= self.window.popleft()[1]
+        if now - self.window_start >= window:
+            rate = self.window_bytes / (window * REAL_TIME_RATE)
+            if rate < self.min_rate:
+                return self.detected(window, "%.2fx real time over %.1fs" %
+                                     (rate, window))
+        return False
+
+    def detected(self, detect_time, reason):
+        self.detect_times.append(detect_time)
+        self.reason = reason
+        return True
+
+    def print_summary(self):
+        if len(self.detect_times) == 0:
+            return
+        print(Fore.YELLOW + "Stalls: " + str(len(self.detect_times)) +
+              ", detected after %.1fs on average (%.1fs max)" %
+              (sum(self.detect_times) / len(self.detect_times),
+               max(self.detect_times)) + Fore.RESET)
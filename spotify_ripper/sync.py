@@ -8,7 +8,6 @@ import os
 import json
 import codecs
 import copy
-import spotify
 
 
 class Sync(object):
@@ -57,26 +56,17 @@ class Sync(object):
         else:
             return {}
 
-    def sync_playlist(self, playlist):
-        args = self.args
-        playlist.load()
+    def sync_playlist(self, source):
+        playlist = source.playlist
         lib = self.load_sync_library(playlist)
         new_lib = {}
 
         print("Syncing playlist " + to_ascii(playlist.name))
 
-        # create new lib
-        for idx, track in enumerate(playlist.tracks):
-            try:
-                track.load()
-                if track.availability != 1 or track.is_local:
-                    continue
-
-                audio_file = self.ripper.format_track_path(idx, track)
-                new_lib[track.link.uri] = audio_file
-
-            except spotify.Error as e:
-                continue
+        # create new lib from the resolved manifest
+        for item in source.items:
+            if item.available:
+                new_lib[item.track.link.uri] = item.audio_file
 
         # check what items are missing or renamed in the new_lib vs lib
         for uri, file_path in lib.items():
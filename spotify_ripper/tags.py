@@ -6,12 +6,113 @@ from colorama import Fore, Style
 from mutagen import mp3, id3, flac, oggvorbis, oggopus, aac
 from stat import ST_SIZE
 from spotify_ripper.utils import *
+from spotify_ripper.analysis import R128_REFERENCE_LOUDNESS
 from datetime import datetime
 import os
 import sys
 import base64
 
 
+def replaygain_tags(loudness, output_type, scope="track"):
+    """returns the ReplayGain tag names and values for the Loudness of a
+    track or album. Opus files get R128 gain tags instead (RFC 7845), a
+    Q7.8 number relative to -23 LUFS"""
+    if loudness is None or loudness.gain is None:
+        return []
+    if not gain_tags_supported(output_type):
+        print(Fore.YELLOW + "Gain tags are not supported for " +
+              output_type + " files with Python 2, skipping" + Fore.RESET)
+        return []
+    if output_type == "opus":
+        gain = int(round((R128_REFERENCE_LOUDNESS - loudness.integrated) *
+                         256))
+        return [("R128_" + scope.upper() + "_GAIN",
+                 str(max(-32768, min(32767, gain))))]
+    prefix = "REPLAYGAIN_" + scope.upper()
+    return [(prefix + "_GAIN", "%.2f dB" % loudness.gain),
+            (prefix + "_PEAK", "%.6f" % loudness.peak)]
+
+
+def gain_tags_supported(output_type):
+    # the M4A tagger of mutagen on Python 2 has no freeform atoms
+    return not (output_type in ["m4a", "alac.m4a"] and
+                sys.version_info < (3, 0))
+
+
+def add_replaygain_tags(output_type, tags, gain_tags):
+    """adds gain values as ID3 TXXX frames, Vorbis comments or MP4
+    freeform atoms, depending on output_type"""
+    for name, value in gain_tags:
+        if output_type in ["mp3", "aac"]:
+            tags.add(id3.TXXX(encoding=3, desc=name, text=[value]))
+        elif output_type in ["flac", "ogg", "opus"]:
+            tags[name] = value
+        elif output_type in ["m4a", "alac.m4a"]:
+            tags["----:com.apple.iTunes:" + name.lower()] = \
+                [value.encode("utf-8")]
+
+
+def clear_tags(args, audio_file):
+    """removes every tag from a copy of another rip, so none of them are
+    left over once it is tagged for its own track"""
+    output_type = args.output_type
+    if output_type in ["mp3", "aac"]:
+        id3.delete(audio_file)
+        return
+    elif output_type == "flac":
+        audio = flac.FLAC(audio_file)
+    elif output_type == "ogg":
+        audio = oggvorbis.OggVorbis(audio_file)
+    elif output_type == "opus":
+        audio = oggopus.OggOpus(audio_file)
+    elif output_type in ["m4a", "alac.m4a"]:
+        from mutagen import mp4
+
+        audio = mp4.MP4(audio_file)
+    else:
+        return
+    audio.delete()
+
+
+def set_album_gain_tags(args, audio_file, loudness):
+    """adds the album gain to a file that was already tagged, the album
+    gain is only known once every track of the album is ripped"""
+    output_type = args.output_type
+    gain_tags = replaygain_tags(loudness, output_type, "album")
+    if len(gain_tags) == 0:
+        return
+
+    if output_type in ["mp3", "aac"]:
+        try:
+            tags = id3.ID3(audio_file)
+        except id3.ID3NoHeaderError:
+            tags = id3.ID3()
+        add_replaygain_tags(output_type, tags, gain_tags)
+        if args.id3_v23:
+            tags.update_to_v23()
+            tags.save(audio_file, v2_version=3, v23_sep='/')
+        else:
+            tags.save(audio_file)
+        return
+    elif output_type == "flac":
+        audio = flac.FLAC(audio_file)
+    elif output_type == "ogg":
+        audio = oggvorbis.OggVorbis(audio_file)
+    elif output_type == "opus":
+        audio = oggopus.OggOpus(audio_file)
+    elif output_type in ["m4a", "alac.m4a"]:
+        from mutagen import mp4
+
+        audio = mp4.MP4(audio_file)
+    else:
+        return
+
+    if audio.tags is None:
+        audio.add_tags()
+    add_replaygain_tags(output_type, audio.tags, gain_tags)
+    audio.save()
+
+
 def set_metadata_tags(args, audio_file, idx, track, ripper):
     # log completed file
     print(Fore.GREEN + Style.BRIGHT + os.path.basename(audio_file) +
@@ -23,53 +124,49 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
               args.output_type + " encoding...")
         return
 
-    # ensure everything is loaded still
-    if not track.is_loaded:
-        track.load()
-    if not track.album.is_loaded:
-        track.album.load()
-    album_browser = track.album.browse()
-    album_browser.load()
-
-    # calculate num of tracks on disc and num of dics
-    num_discs = 0
-    num_tracks = 0
-    for track_browse in album_browser.tracks:
-        if (track_browse.disc == track.disc and
-                track_browse.index > track.index):
-            num_tracks = track_browse.index
-        if track_browse.disc > num_discs:
-            num_discs = track_browse.disc
+    # cached metadata, only loaded from libspotify if needed
+    metadata = ripper.metadata.track(track)
+    album_metadata = ripper.metadata.album(metadata)
+
+    # num of tracks on disc and num of discs
+    num_discs = album_metadata.num_discs
+    num_tracks = album_metadata.num_tracks(metadata.disc)
 
     # try to get genres from Spotify's Web API
     genres = None
     if args.genres is not None:
-        genres = ripper.web.get_genres(args.genres[0], track)
+        genres = ripper.web.get_genres(args.genres[0], metadata)
 
     # use mutagen to update id3v2 tags and vorbis comments
     try:
         audio = None
         on_error = 'replace' if args.ascii_path_only else 'ignore'
-        album = to_ascii(track.album.name, on_error)
-        artist = to_ascii(track.artists[0].name, on_error)
-        title = to_ascii(track.name, on_error)
+        album = to_ascii(metadata.album, on_error)
+        artist = to_ascii(metadata.artists[0], on_error)
+        title = to_ascii(metadata.name, on_error)
 
         # the comment tag can be formatted
         if args.comment is not None:
             comment = \
-                format_track_string(ripper, args.comment[0], idx, track)
+                format_track_string(ripper, args.comment[0], idx, track,
+                                    args)
             comment_ascii = to_ascii(comment, on_error)
 
         if args.grouping is not None:
             grouping = \
-                format_track_string(ripper, args.grouping[0], idx, track)
+                format_track_string(ripper, args.grouping[0], idx, track,
+                                    args)
             grouping_ascii = to_ascii(grouping, on_error)
 
         if genres is not None and genres:
             genres_ascii = [to_ascii(genre) for genre in genres]
 
         # cover art image
-        image = track.album.cover()
+        image = ripper.prefetch.cover(metadata)
+
+        # measured while the track was captured
+        gain_tags = replaygain_tags(ripper.loudness.get(metadata.uri),
+                                    args.output_type)
 
         def tag_to_ascii(_str, _str_ascii):
             return _str if args.ascii_path_only else _str_ascii
@@ -117,21 +214,21 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
 
             if album is not None:
                 audio.tags.add(
-                    id3.TALB(text=[tag_to_ascii(track.album.name, album)],
+                    id3.TALB(text=[tag_to_ascii(metadata.album, album)],
                              encoding=3))
             audio.tags.add(
-                id3.TIT2(text=[tag_to_ascii(track.name, title)],
+                id3.TIT2(text=[tag_to_ascii(metadata.name, title)],
                          encoding=3))
             audio.tags.add(
-                id3.TPE1(text=[tag_to_ascii(track.artists[0].name, artist)],
+                id3.TPE1(text=[tag_to_ascii(metadata.artists[0], artist)],
                          encoding=3))
-            audio.tags.add(id3.TDRC(text=[str(track.album.year)],
+            audio.tags.add(id3.TDRC(text=[str(metadata.year)],
                                     encoding=3))
             audio.tags.add(
-                id3.TPOS(text=[idx_of_total_str(track.disc, num_discs)],
+                id3.TPOS(text=[idx_of_total_str(metadata.disc, num_discs)],
                          encoding=3))
             audio.tags.add(
-                id3.TRCK(text=[idx_of_total_str(track.index, num_tracks)],
+                id3.TRCK(text=[idx_of_total_str(metadata.index, num_tracks)],
                          encoding=3))
             if args.comment is not None:
                 audio.tags.add(
@@ -146,6 +243,7 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
                 tcon_tag.genres = genres if args.ascii_path_only \
                     else genres_ascii
                 audio.tags.add(tcon_tag)
+            add_replaygain_tags(args.output_type, audio.tags, gain_tags)
 
             if args.id3_v23:
                 audio.tags.update_to_v23()
@@ -176,21 +274,21 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
 
             if album is not None:
                 id3_dict.add(
-                    id3.TALB(text=[tag_to_ascii(track.album.name, album)],
+                    id3.TALB(text=[tag_to_ascii(metadata.album, album)],
                              encoding=3))
             id3_dict.add(
-                id3.TIT2(text=[tag_to_ascii(track.name, title)],
+                id3.TIT2(text=[tag_to_ascii(metadata.name, title)],
                          encoding=3))
             id3_dict.add(
-                id3.TPE1(text=[tag_to_ascii(track.artists[0].name, artist)],
+                id3.TPE1(text=[tag_to_ascii(metadata.artists[0], artist)],
                          encoding=3))
-            id3_dict.add(id3.TDRC(text=[str(track.album.year)],
+            id3_dict.add(id3.TDRC(text=[str(metadata.year)],
                                   encoding=3))
             id3_dict.add(
-                id3.TPOS(text=[idx_of_total_str(track.disc, num_discs)],
+                id3.TPOS(text=[idx_of_total_str(metadata.disc, num_discs)],
                          encoding=3))
             id3_dict.add(
-                id3.TRCK(text=[idx_of_total_str(track.index, num_tracks)],
+                id3.TRCK(text=[idx_of_total_str(metadata.index, num_tracks)],
                          encoding=3))
             if args.comment is not None:
                 id3_dict.add(
@@ -205,6 +303,7 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
                 tcon_tag.genres = genres if args.ascii_path_only \
                     else genres_ascii
                 id3_dict.add(tcon_tag)
+            add_replaygain_tags(args.output_type, id3_dict, gain_tags)
 
             if args.id3_v23:
                 id3_dict.update_to_v23()
@@ -234,14 +333,14 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
             save_cover_image(embed_image)
 
             if album is not None:
-                audio.tags["ALBUM"] = tag_to_ascii(track.album.name, album)
-            audio.tags["TITLE"] = tag_to_ascii(track.name, title)
-            audio.tags["ARTIST"] = tag_to_ascii(track.artists[0].name, artist)
-            audio.tags["DATE"] = str(track.album.year)
-            audio.tags["YEAR"] = str(track.album.year)
-            audio.tags["DISCNUMBER"] = str(track.disc)
+                audio.tags["ALBUM"] = tag_to_ascii(metadata.album, album)
+            audio.tags["TITLE"] = tag_to_ascii(metadata.name, title)
+            audio.tags["ARTIST"] = tag_to_ascii(metadata.artists[0], artist)
+            audio.tags["DATE"] = str(metadata.year)
+            audio.tags["YEAR"] = str(metadata.year)
+            audio.tags["DISCNUMBER"] = str(metadata.disc)
             audio.tags["DISCTOTAL"] = str(num_discs)
-            audio.tags["TRACKNUMBER"] = str(track.index)
+            audio.tags["TRACKNUMBER"] = str(metadata.index)
             audio.tags["TRACKTOTAL"] = str(num_tracks)
             if args.comment is not None:
                 audio.tags["COMMENT"] = tag_to_ascii(comment, comment_ascii)
@@ -252,6 +351,7 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
             if genres is not None and genres:
                 _genres = genres if args.ascii_path_only else genres_ascii
                 audio.tags["GENRE"] = ", ".join(_genres)
+            add_replaygain_tags(args.output_type, audio.tags, gain_tags)
 
             audio.save()
 
@@ -267,12 +367,12 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
             save_cover_image(embed_image)
 
             if album is not None:
-                audio.tags["\xa9alb"] = tag_to_ascii(track.album.name, album)
-            audio["\xa9nam"] = tag_to_ascii(track.name, title)
-            audio.tags["\xa9ART"] = tag_to_ascii(track.artists[0].name, artist)
-            audio.tags["\xa9day"] = str(track.album.year)
-            audio.tags["disk"] = [(track.disc, num_discs)]
-            audio.tags["trkn"] = [(track.index, num_tracks)]
+                audio.tags["\xa9alb"] = tag_to_ascii(metadata.album, album)
+            audio["\xa9nam"] = tag_to_ascii(metadata.name, title)
+            audio.tags["\xa9ART"] = tag_to_ascii(metadata.artists[0], artist)
+            audio.tags["\xa9day"] = str(metadata.year)
+            audio.tags["disk"] = [(metadata.disc, num_discs)]
+            audio.tags["trkn"] = [(metadata.index, num_tracks)]
             if args.comment is not None:
                 audio.tags["\xa9cmt"] = tag_to_ascii(comment, comment_ascii)
             if args.grouping is not None:
@@ -281,6 +381,7 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
             if genres is not None and genres:
                 _genres = genres if args.ascii_path_only else genres_ascii
                 audio.tags["\xa9gen"] = ", ".join(_genres)
+            add_replaygain_tags(args.output_type, audio.tags, gain_tags)
 
             audio.save()
 
@@ -294,13 +395,13 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
             save_cover_image(embed_image)
 
             if album is not None:
-                audio.tags[b"\xa9alb"] = tag_to_ascii(track.album.name, album)
-            audio[b"\xa9nam"] = tag_to_ascii(track.name, title)
+                audio.tags[b"\xa9alb"] = tag_to_ascii(metadata.album, album)
+            audio[b"\xa9nam"] = tag_to_ascii(metadata.name, title)
             audio.tags[b"\xa9ART"] = tag_to_ascii(
-                track.artists[0].name, artist)
-            audio.tags[b"\xa9day"] = str(track.album.year)
-            audio.tags[str("disk")] = (track.disc, num_discs)
-            audio.tags[str("trkn")] = (track.index, num_tracks)
+                metadata.artists[0], artist)
+            audio.tags[b"\xa9day"] = str(metadata.year)
+            audio.tags[str("disk")] = (metadata.disc, num_discs)
+            audio.tags[str("trkn")] = (metadata.index, num_tracks)
             if args.comment is not None:
                 audio.tags[b"\xa9cmt"] = tag_to_ascii(comment, comment_ascii)
             if args.grouping is not None:
@@ -379,11 +480,11 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
             print(Fore.YELLOW + "Setting album: " + album + Fore.RESET)
         print(Fore.YELLOW + "Setting title: " + title + Fore.RESET)
         print(Fore.YELLOW + "Setting track info: (" +
-              str(track.index) + ", " + str(num_tracks) + ")" + Fore.RESET)
-        print(Fore.YELLOW + "Setting disc info: (" + str(track.disc) +
+              str(metadata.index) + ", " + str(num_tracks) + ")" + Fore.RESET)
+        print(Fore.YELLOW + "Setting disc info: (" + str(metadata.disc) +
               ", " + str(num_discs) + ")" + Fore.RESET)
         print(Fore.YELLOW + "Setting release year: " +
-              str(track.album.year) + Fore.RESET)
+              str(metadata.year) + Fore.RESET)
         if genres is not None and genres:
             print(Fore.YELLOW + "Setting genres: " +
                   " / ".join(genres_ascii) + Fore.RESET)
@@ -395,6 +496,9 @@ def set_metadata_tags(args, audio_file, idx, track, ripper):
         if args.grouping is not None:
             print(Fore.YELLOW + "Adding grouping: " + grouping_ascii +
                   Fore.RESET)
+        for name, value in gain_tags:
+            print(Fore.YELLOW + "Setting " + name.lower() + ": " + value +
+                  Fore.RESET)
         if args.output_type == "flac":
             bit_rate = ((audio.info.bits_per_sample * audio.info.sample_rate) *
                         audio.info.channels)
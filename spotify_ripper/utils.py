@@ -7,9 +7,12 @@ from datetime import datetime, timedelta
 import mutagen
 import os
 import sys
+import copy
 import errno
 import re
 import math
+import hashlib
+import tempfile
 import unicodedata
 
 
@@ -103,6 +106,42 @@ def rm_file(file_name):
             print(str(e))
 
 
+def temp_path(audio_file):
+    """hidden file next to audio_file that it is written to before it is
+    moved into place"""
+    return os.path.join(os.path.dirname(audio_file),
+                        "." + os.path.basename(audio_file))
+
+
+def encoder_temp_path(audio_file):
+    """a new hidden file next to audio_file for an encoder to write to,
+    each encoder gets its own so two encodes of the same path never
+    share one. Keeps the extension, some encoders pick the container
+    from it"""
+    name, ext = os.path.splitext(os.path.basename(audio_file))
+    fd, temp_file = tempfile.mkstemp(prefix="." + name + ".", suffix=ext,
+                                     dir=os.path.dirname(audio_file) or ".")
+    os.close(fd)
+    return temp_file
+
+
+def iter_uri_file(file_name):
+    """lazily yields the URIs in a file, skipping comments, blank lines and
+    duplicates. Only a 64-bit hash of each URI is remembered"""
+    seen = set()
+    with open(file_name) as uri_file:
+        for line in uri_file:
+            uri = line.strip()
+            if len(uri) == 0 or uri.startswith("#"):
+                continue
+
+            uri_hash = int(hashlib.md5(enc_str(uri)).hexdigest()[:16], 16)
+            if uri_hash in seen:
+                continue
+            seen.add(uri_hash)
+            yield uri
+
+
 def default_settings_dir():
     return norm_path(os.path.join(os.path.expanduser("~"), ".spotify-ripper"))
 
@@ -113,8 +152,27 @@ def settings_dir():
         else default_settings_dir()
 
 
-def base_dir():
-    args = get_args()
+def apply_arg_options(args, options):
+    """set options on the shared args, returns the previous values so
+    they can be restored the same way"""
+    previous = {}
+    for option, value in options.items():
+        previous[option] = getattr(args, option, None)
+        setattr(args, option, value)
+    return previous
+
+
+def output_args(args, options):
+    """a copy of args with the options of an output set, the shared args
+    stay the same for the other threads"""
+    _args = copy.copy(args)
+    apply_arg_options(_args, options)
+    return _args
+
+
+def base_dir(args=None):
+    if args is None:
+        args = get_args()
     return norm_path(args.directory[0]) if args.directory is not None \
         else os.getcwd()
 
@@ -161,26 +219,21 @@ def get_playlist_track(track, playlist):
     return None
 
 
-def format_track_string(ripper, format_string, idx, track):
-    args = get_args()
+def format_track_string(ripper, format_string, idx, track, args=None):
+    if args is None:
+        args = get_args()
     current_album = ripper.current_album
     current_playlist = ripper.current_playlist
 
-    # this fixes the track.disc
-    if not track.is_loaded:
-        track.load()
-    if not track.album.is_loaded:
-        track.album.load()
-    album_browser = track.album.browse()
-    album_browser.load()
+    # cached metadata, this also fixes the track.disc
+    metadata = ripper.metadata.track(track)
+    album_metadata = ripper.metadata.album(metadata)
 
     track_artist = to_ascii(
-        escape_filename_part(track.artists[0].name))
-    track_artists = to_ascii(", ".join(
-        [artist.name for artist in track.artists]))
-    if len(track.artists) > 1:
-        featuring_artists = to_ascii(", ".join(
-            [artist.name for artist in track.artists[1:]]))
+        escape_filename_part(metadata.artists[0]))
+    track_artists = to_ascii(", ".join(metadata.artists))
+    if len(metadata.artists) > 1:
+        featuring_artists = to_ascii(", ".join(metadata.artists[1:]))
     else:
         featuring_artists = ""
 
@@ -197,21 +250,15 @@ def format_track_string(ripper, format_string, idx, track):
         if artist_array is not None:
             album_artists_web = to_ascii(", ".join(artist_array))
 
-    album = to_ascii(escape_filename_part(track.album.name))
-    track_name = to_ascii(escape_filename_part(track.name))
-    year = str(track.album.year)
+    album = to_ascii(escape_filename_part(metadata.album))
+    track_name = to_ascii(escape_filename_part(metadata.name))
+    year = str(metadata.year)
     extension = args.output_type
     idx_str = str(idx + 1)
-    track_num = str(track.index)
-    disc_num = str(track.disc)
-
-    # calculate num of discs on the album
-    num_discs = 0
-    for track_browse in album_browser.tracks:
-        if track_browse.disc > num_discs:
-            num_discs = track_browse.disc
+    track_num = str(metadata.index)
+    disc_num = str(metadata.disc)
 
-    if num_discs >= 2:
+    if album_metadata.num_discs >= 2:
         smart_num = str((int(disc_num) * 100) + int(track_num))
     else:
         smart_num = track_num
@@ -230,10 +277,8 @@ def format_track_string(ripper, format_string, idx, track):
     copyright = label = ""
     if (format_string.find("{copyright}") >= 0 or
             format_string.find("{label}") >= 0):
-        album_browser = track.album.browse()
-        album_browser.load()
-        if len(album_browser.copyrights) > 0:
-            copyright = escape_filename_part(album_browser.copyrights[0])
+        if len(album_metadata.copyrights) > 0:
+            copyright = escape_filename_part(album_metadata.copyrights[0])
             label = re.sub(r"^[0-9]+\s+", "", copyright)
 
     # load playlist create time or creator only if needed
@@ -25,18 +25,19 @@ class WebAPI(object):
     def get_cached_result(self, uri):
         return self.cache.get(uri)
 
-    def request_json(self, url, msg):
-        res = self.request_url(url, msg)
+    def request_json(self, url, msg, verbose=True):
+        res = self.request_url(url, msg, verbose)
         return res.json() if res is not None else res
 
-    def request_url(self, url, msg):
-        print(Fore.GREEN + "Attempting to retrieve " + msg +
-              " from Spotify's Web API" + Fore.RESET)
-        print(Fore.CYAN + url + Fore.RESET)
+    def request_url(self, url, msg, verbose=True):
+        if verbose:
+            print(Fore.GREEN + "Attempting to retrieve " + msg +
+                  " from Spotify's Web API" + Fore.RESET)
+            print(Fore.CYAN + url + Fore.RESET)
         res = requests.get(url)
         if res.status_code == 200:
             return res
-        else:
+        elif verbose:
             print(Fore.YELLOW + "URL returned non-200 HTTP code: " +
                   str(res.status_code) + Fore.RESET)
         return None
@@ -122,14 +123,14 @@ class WebAPI(object):
         return result
 
     # genre_type can be "artist" or "album"
-    def get_genres(self, genre_type, track):
+    def get_genres(self, genre_type, metadata, verbose=True):
         def get_genre_json(spotify_id):
             url = self.api_url(genre_type + 's/' + spotify_id)
-            return self.request_json(url, "genres")
+            return self.request_json(url, "genres", verbose)
 
         # extract album id from uri
-        item = track.artists[0] if genre_type == "artist" else track.album
-        uri = item.link.uri
+        uri = metadata.artist_uris[0] if genre_type == "artist" \
+            else metadata.album_uri
 
         # check for cached result
         cached_result = self.get_cached_result(uri)